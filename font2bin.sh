@@ -7,28 +7,20 @@ else
     echo "SRC FONT : "$1
     SRCFONT=$1
     FOLDER=$(echo $1 | awk -F'.' '{print $(NF-1)}')
-    INDEX=1
     shift
-    echo "Index  FONT" > mapping.log
+    DST_DIRS=()
     for FAMILY in "$@"
     do
       echo "FONT FAMILY : "$FAMILY
       if [ -d fonts/$FAMILY ]; then
-	for TARGETFONT in $(find fonts/$FAMILY -type f | sort)
-	do
-	  echo "TARGET FONT : "$TARGETFONT
-	  echo "font2img.py $SRCFONT $TARGETFONT"
-	  mkdir -p image/$FOLDER
-	  poetry run font2img --src_font=fonts/$SRCFONT --dst_font=$TARGETFONT --sample_count=2000 --sample_dir=image/$FOLDER --label=${INDEX} --filter=1
-	  TARGET=$(echo $TARGETFONT | awk -F'/' '{print $(NF)}')
-	  echo "  $INDEX    $TARGET" >> mapping.log
-	  ((INDEX++))
-	done
+        DST_DIRS+=("--dst-dir=fonts/$FAMILY")
       fi
     done
+    mkdir -p image/$FOLDER
+    poetry run font2img --src-font=fonts/$SRCFONT "${DST_DIRS[@]}" --sample-count=2000 --sample-dir=image/$FOLDER --label=1 --filter=1 --mapping=mapping.json --workers=$(nproc) --glyph-cache-dir=cache/glyphs
     echo "package.py image/$FOLDER binary/$FOLDER/data"
     mkdir -p binary/$FOLDER/data
-    poetry run package --dir=image/$FOLDER --save_dir=binary/$FOLDER/data
+    poetry run package --dir=image/$FOLDER --save-dir=binary/$FOLDER/data
   else
     echo "Source font 'fonts/$1' not exist"
   fi
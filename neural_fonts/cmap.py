@@ -0,0 +1,137 @@
+import struct
+
+import numpy as np
+
+# preferred (platform id, encoding id) of unicode cmap subtables,
+# full repertoire tables before BMP only ones
+UNICODE_ENCODINGS = [(3, 10), (0, 6), (0, 4), (3, 1), (0, 3), (0, 2), (0, 1), (0, 0)]
+
+
+def read_tables(data: bytes, font_index: int = 0) -> dict[bytes, tuple[int, int]]:
+    """
+    Read the table directory of a TrueType/OpenType font (or collection)
+    Returns tag -> (offset, length)
+    """
+    offset = 0
+    if data[:4] == b"ttcf":
+        num_fonts = struct.unpack_from(">I", data, 8)[0]
+        if font_index >= num_fonts:
+            raise ValueError("font index %d out of range" % font_index)
+        offset = struct.unpack_from(">I", data, 12 + 4 * font_index)[0]
+    num_tables = struct.unpack_from(">H", data, offset + 4)[0]
+    tables: dict[bytes, tuple[int, int]] = {}
+    for i in range(num_tables):
+        tag, _, table_offset, length = struct.unpack_from(
+            ">4sIII", data, offset + 12 + 16 * i
+        )
+        tables[tag] = (table_offset, length)
+    return tables
+
+
+def parse_format4(data: bytes, offset: int) -> dict[int, int]:
+    seg_count = struct.unpack_from(">H", data, offset + 6)[0] // 2
+    end_codes = struct.unpack_from(">%dH" % seg_count, data, offset + 14)
+    start_offset = offset + 16 + 2 * seg_count
+    start_codes = struct.unpack_from(">%dH" % seg_count, data, start_offset)
+    deltas = struct.unpack_from(">%dh" % seg_count, data, start_offset + 2 * seg_count)
+    range_offsets_offset = start_offset + 4 * seg_count
+    range_offsets = struct.unpack_from(">%dH" % seg_count, data, range_offsets_offset)
+
+    mapping: dict[int, int] = {}
+    for i in range(seg_count):
+        for code in range(start_codes[i], min(end_codes[i], 0xFFFE) + 1):
+            if range_offsets[i] == 0:
+                glyph = (code + deltas[i]) & 0xFFFF
+            else:
+                address = (
+                    range_offsets_offset
+                    + 2 * i
+                    + range_offsets[i]
+                    + 2 * (code - start_codes[i])
+                )
+                glyph = struct.unpack_from(">H", data, address)[0]
+                if glyph:
+                    glyph = (glyph + deltas[i]) & 0xFFFF
+            if glyph:
+                mapping[code] = glyph
+    return mapping
+
+
+def parse_format12(data: bytes, offset: int) -> dict[int, int]:
+    num_groups = struct.unpack_from(">I", data, offset + 12)[0]
+    mapping: dict[int, int] = {}
+    for i in range(num_groups):
+        start, end, glyph = struct.unpack_from(">III", data, offset + 16 + 12 * i)
+        for code in range(start, end + 1):
+            if glyph + code - start:
+                mapping[code] = glyph + code - start
+    return mapping
+
+
+def read_cmap(data: bytes, tables: dict[bytes, tuple[int, int]]) -> dict[int, int]:
+    """
+    Map code points to glyph ids using the best unicode cmap subtable
+    """
+    cmap_offset = tables[b"cmap"][0]
+    num_subtables = struct.unpack_from(">H", data, cmap_offset + 2)[0]
+    subtables: dict[tuple[int, int], int] = {}
+    for i in range(num_subtables):
+        platform, encoding, offset = struct.unpack_from(
+            ">HHI", data, cmap_offset + 4 + 8 * i
+        )
+        subtables.setdefault((platform, encoding), cmap_offset + offset)
+
+    for encoding in UNICODE_ENCODINGS:
+        if encoding not in subtables:
+            continue
+        offset = subtables[encoding]
+        subtable_format = struct.unpack_from(">H", data, offset)[0]
+        if subtable_format == 4:
+            return parse_format4(data, offset)
+        if subtable_format == 12:
+            return parse_format12(data, offset)
+    raise ValueError("no supported unicode cmap subtable")
+
+
+def read_empty_glyphs(
+    data: bytes, tables: dict[bytes, tuple[int, int]]
+) -> set[int] | None:
+    """
+    Glyph ids without any outline, read from the TrueType loca table.
+    Returns None for fonts without one (e.g. CFF outlines)
+    """
+    if b"loca" not in tables or b"head" not in tables or b"maxp" not in tables:
+        return None
+    num_glyphs = struct.unpack_from(">H", data, tables[b"maxp"][0] + 4)[0]
+    long_offsets = struct.unpack_from(">h", data, tables[b"head"][0] + 50)[0]
+    loca = np.frombuffer(
+        data,
+        dtype=">u4" if long_offsets else ">u2",
+        count=num_glyphs + 1,
+        offset=tables[b"loca"][0],
+    )
+    return set(np.flatnonzero(loca[1:] == loca[:-1]).tolist())
+
+
+def glyph_coverage(path: str, font_index: int = 0) -> tuple[set[int], bool] | None:
+    """
+    Code points that the font maps to a glyph other than .notdef, and
+    whether glyphs with an empty outline were left out too. Only TrueType
+    outlines (loca table) can be checked for that, callers should still
+    detect blank glyphs from rendered bitmaps when it is False.
+    Returns None when the font tables can not be read, callers should then
+    fall back to detecting missing glyphs from rendered bitmaps
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        tables = read_tables(data, font_index)
+        mapping = read_cmap(data, tables)
+        empty_glyphs = read_empty_glyphs(data, tables)
+    except (KeyError, ValueError, struct.error):
+        return None
+    if not mapping:
+        return None
+    if empty_glyphs is None:
+        return set(mapping), False
+    return {code for code, glyph in mapping.items() if glyph not in empty_glyphs}, True
@@ -1,4 +1,11 @@
+from __future__ import annotations
+
 import collections
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
 import os
 from typing import TYPE_CHECKING
 
@@ -6,10 +13,17 @@ import click
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
+from neural_fonts.cmap import glyph_coverage
+from neural_fonts.package import DATASET_FORMATS, DatasetWriter
+
 KR_CHARSET = None
 
 if TYPE_CHECKING:
-    from typing import Literal, Tuple, TypeVar
+    from multiprocessing.pool import AsyncResult, Pool
+    from typing import Iterator, Literal, Tuple, TypeVar
+
+    # a rendered example, PNG encoded or as a raw (canvas, canvas * 2) array
+    Encoded = bytes | np.ndarray
 
 
 def get_offset(
@@ -43,6 +57,109 @@ def draw_single_char(
     return img
 
 
+def glyph_hash(data: bytes) -> int:
+    """
+    Content hash of a rendered glyph, stable across processes
+    (unlike the builtin hash, which is salted per interpreter)
+    """
+    return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little")
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class GlyphCache:
+    """
+    On-disk cache of rendered glyphs.
+    Entries are keyed by the content of the font file rather than its path,
+    so the source glyphs are shared by every run over the same source font.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self._font_hashes: dict[str, str] = {}
+
+    def font_hash(self, path: str) -> str:
+        font_hash = self._font_hashes.get(path)
+        if font_hash is None:
+            font_hash = file_hash(path)
+            self._font_hashes[path] = font_hash
+        return font_hash
+
+    def entry_path(
+        self,
+        ch: str,
+        font: ImageFont.FreeTypeFont,
+        canvas_size: int,
+        x_offset: float,
+        y_offset: float,
+    ) -> str:
+        assert isinstance(font.path, str), "cached fonts must be loaded from a file"
+        entry_dir = "%s_%d_%d_%g_%g" % (
+            self.font_hash(font.path),
+            font.size,
+            canvas_size,
+            x_offset,
+            y_offset,
+        )
+        return os.path.join(self.cache_dir, entry_dir, "%05X.raw" % ord(ch))
+
+    def draw(
+        self,
+        ch: str,
+        font: ImageFont.FreeTypeFont,
+        canvas_size: int,
+        x_offset: float,
+        y_offset: float,
+    ) -> Image.Image:
+        """
+        Same as draw_single_char, reading the glyph from the cache when present
+        """
+        data = self.load(ch, font, canvas_size, x_offset, y_offset)
+        if data is not None:
+            return Image.frombytes("L", (canvas_size, canvas_size), data)
+
+        img = draw_single_char(ch, font, canvas_size, x_offset, y_offset)
+        self.store(ch, font, canvas_size, x_offset, y_offset, img.tobytes())
+        return img
+
+    def load(
+        self,
+        ch: str,
+        font: ImageFont.FreeTypeFont,
+        canvas_size: int,
+        x_offset: float,
+        y_offset: float,
+    ) -> bytes | None:
+        path = self.entry_path(ch, font, canvas_size, x_offset, y_offset)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def store(
+        self,
+        ch: str,
+        font: ImageFont.FreeTypeFont,
+        canvas_size: int,
+        x_offset: float,
+        y_offset: float,
+        data: bytes,
+    ) -> None:
+        path = self.entry_path(ch, font, canvas_size, x_offset, y_offset)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # several workers may render the same glyph, the last rename wins
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
 def draw_example(
     ch: str,
     src_font: ImageFont.FreeTypeFont,
@@ -51,13 +168,15 @@ def draw_example(
     src_offset: Tuple[int, int],
     dst_offset,
     filter_hashes: set,
+    src_cache: GlyphCache | None = None,
 ):
     dst_img = draw_single_char(ch, dst_font, canvas_size, dst_offset[0], dst_offset[1])
     # check the filter example in the hashes or not
-    dst_hash = hash(dst_img.tobytes())
+    dst_hash = glyph_hash(dst_img.tobytes())
     if dst_hash in filter_hashes:
         return None
-    src_img = draw_single_char(ch, src_font, canvas_size, src_offset[0], src_offset[1])
+    draw_src = src_cache.draw if src_cache else draw_single_char
+    src_img = draw_src(ch, src_font, canvas_size, src_offset[0], src_offset[1])
     example_img = Image.new(
         "RGB", (canvas_size * 2, canvas_size), (255, 255, 255)
     ).convert("L")
@@ -66,6 +185,107 @@ def draw_example(
     return example_img
 
 
+class PairBuffer:
+    """
+    Preallocated (n, canvas, canvas * 2) uint8 block of example pairs.
+    The target (left) and source (right) half of every slot is also
+    exposed as a PIL image sharing the buffer memory, so glyphs are
+    rasterized in place instead of into per-glyph images
+    """
+
+    def __init__(self, n: int, canvas_size: int):
+        self.canvas_size = canvas_size
+        pair_size = canvas_size * canvas_size * 2
+        # PIL maps a half as canvas_size rows of stride 2 * canvas_size,
+        # which runs canvas_size bytes past the last source half
+        self._memory = np.full(n * pair_size + canvas_size, 255, dtype=np.uint8)
+        self.pairs = self._memory[: n * pair_size].reshape(
+            n, canvas_size, canvas_size * 2
+        )
+        self.halves = [
+            (self._view(i * pair_size), self._view(i * pair_size + canvas_size))
+            for i in range(n)
+        ]
+
+    def _view(self, offset: int) -> Image.Image:
+        size = self.canvas_size
+        view = Image.frombuffer(
+            "L", (size, size), self._memory[offset:], "raw", "L", size * 2, 1
+        )
+        # writes go straight to the numpy buffer
+        view.readonly = 0
+        return view
+
+    def __len__(self) -> int:
+        return len(self.pairs)
+
+
+def draw_char_into(
+    view: Image.Image,
+    ch: str,
+    font: ImageFont.FreeTypeFont,
+    x_offset: float,
+    y_offset: float,
+) -> None:
+    """
+    draw_single_char onto an already white canvas
+    """
+    ImageDraw.Draw(view).text((x_offset, y_offset), ch, 0, font=font)
+
+
+def draw_example_into(
+    buffer: PairBuffer,
+    index: int,
+    ch: str,
+    src_font: ImageFont.FreeTypeFont,
+    dst_font: ImageFont.FreeTypeFont | None,
+    src_offset: Tuple[int, int],
+    dst_offset: Tuple[float, float],
+    filter_hashes: set[int],
+    src_cache: GlyphCache | None = None,
+    dst_image: Image.Image | None = None,
+) -> bool:
+    """
+    Array counterpart of draw_example (or draw_handwriting when dst_image is
+    given) writing the pair into slot index of buffer.
+    Returns False when the example is filtered, draw_example stays the
+    reference for the pixels produced here
+    """
+    canvas_size = buffer.canvas_size
+    pair = buffer.pairs[index]
+    dst_view, src_view = buffer.halves[index]
+    pair.fill(255)
+    if dst_image is not None:
+        pair[:, :canvas_size] = np.asarray(dst_image.convert("L"))
+    else:
+        assert dst_font is not None
+        draw_char_into(dst_view, ch, dst_font, dst_offset[0], dst_offset[1])
+        if glyph_hash(pair[:, :canvas_size].tobytes()) in filter_hashes:
+            return False
+
+    cached = (
+        src_cache.load(ch, src_font, canvas_size, src_offset[0], src_offset[1])
+        if src_cache
+        else None
+    )
+    if cached is not None:
+        pair[:, canvas_size:] = np.frombuffer(cached, dtype=np.uint8).reshape(
+            canvas_size, canvas_size
+        )
+    else:
+        draw_char_into(src_view, ch, src_font, src_offset[0], src_offset[1])
+        if src_cache:
+            src_cache.store(
+                ch,
+                src_font,
+                canvas_size,
+                src_offset[0],
+                src_offset[1],
+                pair[:, canvas_size:].tobytes(),
+            )
+    return True
+
+
 def get_font_offset(
     charset: list[str],
     font: ImageFont.FreeTypeFont,
@@ -78,11 +298,11 @@ def get_font_offset(
     sample = copied_charset[:2000]
 
     # Get the mean of font offset
-    font_offset = np.array([0, 0])
+    font_offset = np.array([0.0, 0.0])
     count = 0
     for c in sample:
         font_img = draw_single_char(c, font, canvas_size, 0, 0)
-        font_hash = hash(font_img.tobytes())
+        font_hash = glyph_hash(font_img.tobytes())
         if font_hash not in filter_hashes:
             font_offset += get_offset(c, font, canvas_size)
             count += 1
@@ -90,6 +310,24 @@ def get_font_offset(
     return font_offset
 
 
+def get_metric_font_offset(
+    chars: list[str],
+    font: ImageFont.FreeTypeFont,
+    canvas_size: int,
+) -> np.ndarray:
+    """
+    Mean offset of characters known to exist in the font, from the glyph
+    metrics only. Samples 2000 evenly spaced characters, so the result
+    does not depend on the random state
+    """
+    sample = chars[:: max(1, len(chars) // 2000)][:2000]
+    font_offset = np.array([0.0, 0.0])
+    for c in sample:
+        font_offset += get_offset(c, font, canvas_size)
+    font_offset /= len(sample)
+    return font_offset
+
+
 def filter_recurring_hash(
     charset: list[str],
     font: ImageFont.FreeTypeFont,
@@ -110,7 +348,7 @@ def filter_recurring_hash(
     hash_count: collections.defaultdict[int, int] = collections.defaultdict(int)
     for c in sample:
         img = draw_single_char(c, font, canvas_size, x_offset, y_offset)
-        hash_count[hash(img.tobytes())] += 1
+        hash_count[glyph_hash(img.tobytes())] += 1
 
     # Filter the hash value that appeared more than twice
     recurring_hashes = filter(lambda d: d[1] > 2, hash_count.items())
@@ -139,6 +377,7 @@ def draw_handwriting(
     canvas_size: int,
     src_offset: Tuple[int, int],
     dst_folder: str,
+    src_cache: GlyphCache | None = None,
 ) -> None | Image.Image:
     s = ch.encode("unicode-escape").decode("utf-8").replace("\\u", "").upper()
     dst_path = os.path.join(dst_folder, f"uni{s}.png")
@@ -147,7 +386,8 @@ def draw_handwriting(
     dst_img = Image.open(dst_path)
 
     # check the filter example in the hashes or not
-    src_img = draw_single_char(ch, src_font, canvas_size, src_offset[0], src_offset[1])
+    draw_src = src_cache.draw if src_cache else draw_single_char
+    src_img = draw_src(ch, src_font, canvas_size, src_offset[0], src_offset[1])
     example_img = Image.new(
         "RGB", (canvas_size * 2, canvas_size), (255, 255, 255)
     ).convert("L")
@@ -156,6 +396,324 @@ def draw_handwriting(
     return example_img
 
 
+# the source font and the destination fonts of the families in flight;
+# families are rendered one after another, so finished ones are evicted
+_loaded_fonts: collections.OrderedDict[tuple[str, int], ImageFont.FreeTypeFont]
+_loaded_fonts = collections.OrderedDict()
+_max_loaded_fonts = 8
+
+
+def load_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    """
+    Load a font once per process; worker processes keep the handles of the
+    most recently used fonts instead of reopening the file for every glyph
+    """
+    key = (path, size)
+    font = _loaded_fonts.get(key)
+    if font is None:
+        font = ImageFont.truetype(path, size=size)
+        _loaded_fonts[key] = font
+        if len(_loaded_fonts) > _max_loaded_fonts:
+            _loaded_fonts.popitem(last=False)
+    else:
+        _loaded_fonts.move_to_end(key)
+    return font
+
+
+class ExampleRenderer:
+    """
+    Picklable description of how to draw the examples of one target font,
+    so the same rendering runs in the main process or in a worker pool
+    """
+
+    def __init__(
+        self,
+        src: str,
+        dst: str,
+        char_size: int,
+        canvas_size: int,
+        src_offset: Tuple[int, int],
+        dst_offset: Tuple[float, float],
+        filter_hashes: set[int],
+        handwriting_dir: Literal[False] | str = False,
+        glyph_cache: GlyphCache | None = None,
+        encoding: str = "png",
+        backend: str = "pil",
+    ):
+        self.src = src
+        self.dst = dst
+        self.char_size = char_size
+        self.canvas_size = canvas_size
+        self.src_offset = src_offset
+        self.dst_offset = dst_offset
+        self.filter_hashes = filter_hashes
+        self.handwriting_dir = handwriting_dir
+        self.glyph_cache = glyph_cache
+        self.encoding = encoding
+        self.backend = backend
+
+    def draw(self, mode: str, ch: str) -> None | Image.Image:
+        """
+        mode is one of "filtered", "unfiltered" or "handwriting"
+        """
+        src_font = load_font(self.src, self.char_size)
+        if mode == "handwriting":
+            assert self.handwriting_dir
+            return draw_handwriting(
+                ch,
+                src_font,
+                self.canvas_size,
+                self.src_offset,
+                self.handwriting_dir,
+                self.glyph_cache,
+            )
+        return draw_example(
+            ch,
+            src_font,
+            load_font(self.dst, self.char_size),
+            self.canvas_size,
+            self.src_offset,
+            self.dst_offset,
+            self.filter_hashes if mode == "filtered" else set(),
+            self.glyph_cache,
+        )
+
+    def render(self, mode: str, ch: str) -> None | Encoded:
+        """
+        Draw an example encoded as PNG bytes, or as a raw uint8 array
+        when the renderer writes straight into a dataset
+        """
+        if self.backend == "numpy":
+            return self.render_chunk(mode, [ch])[0]
+        example = self.draw(mode, ch)
+        if example is None:
+            return None
+        if self.encoding == "raw":
+            return np.asarray(example, dtype=np.uint8)
+        return encode_png(example)
+
+    def draw_into(self, buffer: PairBuffer, mode: str, chars: list[str]) -> list[bool]:
+        """
+        Draw chars into the slots of buffer, returning which were kept
+        """
+        src_font = load_font(self.src, self.char_size)
+        dst_font = (
+            None if mode == "handwriting" else load_font(self.dst, self.char_size)
+        )
+        filter_hashes = self.filter_hashes if mode == "filtered" else set()
+        kept: list[bool] = []
+        for i, ch in enumerate(chars):
+            dst_image = None
+            if mode == "handwriting":
+                assert self.handwriting_dir
+                dst_path = os.path.join(
+                    self.handwriting_dir, f"uni{unicode_name(ch)}.png"
+                )
+                if not os.path.exists(dst_path):
+                    kept.append(False)
+                    continue
+                dst_image = Image.open(dst_path)
+            kept.append(
+                draw_example_into(
+                    buffer,
+                    i,
+                    ch,
+                    src_font,
+                    dst_font,
+                    self.src_offset,
+                    self.dst_offset,
+                    filter_hashes,
+                    self.glyph_cache,
+                    dst_image,
+                )
+            )
+        return kept
+
+    def render_chunk(self, mode: str, chars: list[str]) -> list[None | Encoded]:
+        if self.backend != "numpy":
+            return [self.render(mode, c) for c in chars]
+        if self.encoding == "raw":
+            # the returned arrays are views of this one block
+            buffer = PairBuffer(len(chars), self.canvas_size)
+        else:
+            buffer = pair_buffer(len(chars), self.canvas_size)
+        kept = self.draw_into(buffer, mode, chars)
+        results: list[None | Encoded] = []
+        for i, keep in enumerate(kept):
+            if not keep:
+                results.append(None)
+            elif self.encoding == "raw":
+                results.append(buffer.pairs[i])
+            else:
+                results.append(encode_png(Image.fromarray(buffer.pairs[i])))
+        return results
+
+
+_pair_buffers: dict[tuple[int, int], PairBuffer] = {}
+
+
+def pair_buffer(n: int, canvas_size: int) -> PairBuffer:
+    """
+    Per process buffer reused by every chunk that is PNG encoded
+    """
+    key = (n, canvas_size)
+    if key not in _pair_buffers:
+        _pair_buffers[key] = PairBuffer(n, canvas_size)
+    return _pair_buffers[key]
+
+
+def encode_png(img: Image.Image) -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def _render_chunk(task: tuple[ExampleRenderer, str, list[str]]) -> list[None | Encoded]:
+    renderer, mode, chars = task
+    return renderer.render_chunk(mode, chars)
+
+
+def render_examples(
+    renderer: ExampleRenderer,
+    chars: list[str],
+    mode: str,
+    pool: Pool | None = None,
+    workers: int = 1,
+    chunk_size: int = 32,
+) -> Iterator[tuple[str, None | Encoded]]:
+    """
+    Yield (char, encoded example or None) in the order of chars.
+    With a pool, only a bounded number of chunks is in flight, so a
+    consumer that stops early (--sample-count) does not render the rest
+    """
+    chunks = [chars[i : i + chunk_size] for i in range(0, len(chars), chunk_size)]
+    if pool is None:
+        for chunk in chunks:
+            yield from zip(chunk, renderer.render_chunk(mode, chunk))
+        return
+
+    pending: collections.deque[tuple[list[str], AsyncResult[list[None | Encoded]]]]
+    pending = collections.deque()
+    next_chunk = 0
+    while next_chunk < len(chunks) or pending:
+        while next_chunk < len(chunks) and len(pending) < workers * 2:
+            chunk = chunks[next_chunk]
+            pending.append(
+                (chunk, pool.apply_async(_render_chunk, ((renderer, mode, chunk),)))
+            )
+            next_chunk += 1
+        chunk, result = pending.popleft()
+        yield from zip(chunk, result.get())
+
+
+def unicode_name(ch: str) -> str:
+    return ch.encode("unicode-escape").decode("utf-8").replace("\\u", "").upper()
+
+
+def char_code(ch: str) -> str:
+    """
+    Code of the example of a character, its code point in hex, so the
+    name and the train/val split of a glyph do not depend on render order
+    """
+    return f"{ord(ch):04X}"
+
+
+class ImageDirWriter:
+    """
+    Save examples as PNG files named {label}_{code}[_{split}].png,
+    the layout read by package.py
+    """
+
+    encoding = "png"
+
+    def __init__(self, sample_dir: str):
+        self.sample_dir = sample_dir
+        if not os.path.exists(sample_dir):
+            os.makedirs(sample_dir)
+
+    def name(self, label: int, code: str, split: str | None) -> str:
+        return f"{label}_{code}_{split}.png" if split else f"{label}_{code}.png"
+
+    def write(self, label: int, code: str, split: str | None, data: Encoded) -> None:
+        name = self.name(label, code, split)
+        with open(os.path.join(self.sample_dir, name), "wb") as f:
+            f.write(bytes(data))
+
+    def close(self) -> None:
+        pass
+
+
+class RenderManifest:
+    """
+    Append-only record of (render key -> output file name) kept next to
+    the examples, so a rerun only renders missing or changed examples.
+    A key covers the font contents, the character and every drawing
+    parameter; filtered characters are recorded with no file
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: dict[str, str | None] = {}
+        self._file_hashes: dict[str, str] = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # a line cut short by an interrupted run
+                        continue
+                    self.entries[entry["key"]] = entry["file"]
+        self.file = open(path, "a")
+
+    def file_hash(self, path: str) -> str:
+        if path not in self._file_hashes:
+            self._file_hashes[path] = file_hash(path)
+        return self._file_hashes[path]
+
+    def key(self, renderer: ExampleRenderer, mode: str, ch: str) -> str | None:
+        if mode == "handwriting":
+            assert renderer.handwriting_dir
+            dst_path = os.path.join(
+                renderer.handwriting_dir, f"uni{unicode_name(ch)}.png"
+            )
+            if not os.path.exists(dst_path):
+                return None
+            dst_hash = file_hash(dst_path)
+        else:
+            dst_hash = self.file_hash(renderer.dst)
+        params = [
+            self.file_hash(renderer.src),
+            dst_hash,
+            mode,
+            ch,
+            renderer.char_size,
+            renderer.canvas_size,
+            list(renderer.src_offset),
+            [round(float(o), 6) for o in renderer.dst_offset],
+            sorted(renderer.filter_hashes) if mode == "filtered" else [],
+        ]
+        return hashlib.sha1(json.dumps(params).encode("utf-8")).hexdigest()
+
+    def record(self, key: str, name: str | None) -> None:
+        self.entries[key] = name
+        self.file.write(json.dumps({"key": key, "file": name}) + "\n")
+        self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+
+class Rendered:
+    """
+    Marker for an example found in the manifest instead of being rendered
+    """
+
+    def __init__(self, key: str, name: str | None):
+        self.key = key
+        self.name = name
+
+
 def font2img(
     src: str,
     dst: str,
@@ -171,40 +729,195 @@ def font2img(
     fixed_sample: bool = False,
     all_sample: bool = False,
     handwriting_dir: Literal[False] | str = False,
+    workers: int = 1,
+    pool: Pool | None = None,
+    glyph_cache: GlyphCache | None = None,
+    use_cmap: bool = True,
+    writer: ImageDirWriter | DatasetWriter | None = None,
+    manifest: RenderManifest | None = None,
+    resume: bool = False,
+    backend: str = "pil",
+):
+    """
+    Render the examples of one target font.
+    A writer, worker pool or manifest that is not given is created
+    (and closed) here; with resume, examples recorded in the sample_dir
+    manifest are not rendered again
+    """
+    with contextlib.ExitStack() as stack:
+        if writer is None:
+            writer = ImageDirWriter(sample_dir)
+            stack.callback(writer.close)
+        if pool is None and workers > 1:
+            pool = stack.enter_context(multiprocessing.Pool(workers))
+        if manifest is None and resume and isinstance(writer, ImageDirWriter):
+            manifest = RenderManifest(os.path.join(sample_dir, "manifest.jsonl"))
+            stack.callback(manifest.close)
+        render_font(
+            src,
+            dst,
+            charset,
+            char_size,
+            canvas_size,
+            x_offset,
+            y_offset,
+            sample_count,
+            label,
+            filter_by_hash,
+            fixed_sample,
+            all_sample,
+            handwriting_dir,
+            workers,
+            pool,
+            glyph_cache,
+            use_cmap,
+            writer,
+            manifest,
+            backend,
+        )
+
+
+def render_font(
+    src: str,
+    dst: str,
+    charset: list[str],
+    char_size: int,
+    canvas_size: int,
+    x_offset: int,
+    y_offset: int,
+    sample_count: int,
+    label: int,
+    filter_by_hash: bool,
+    fixed_sample: bool,
+    all_sample: bool,
+    handwriting_dir: Literal[False] | str,
+    workers: int,
+    pool: Pool | None,
+    glyph_cache: GlyphCache | None,
+    use_cmap: bool,
+    writer: ImageDirWriter | DatasetWriter,
+    manifest: RenderManifest | None,
+    backend: str,
 ):
-    src_font: ImageFont.FreeTypeFont = ImageFont.truetype(src, size=char_size)
-    dst_font: ImageFont.FreeTypeFont = ImageFont.truetype(dst, size=char_size)
+    dst_font = load_font(dst, char_size)
 
-    dst_filter_hashes = set(filter_recurring_hash(charset, dst_font, canvas_size, 0, 0))
-    dst_offset = get_font_offset(charset, dst_font, canvas_size, dst_filter_hashes)
+    coverage = glyph_coverage(dst) if use_cmap else None
+    covered: list[str] = []
+    outlines_checked = False
+    if coverage is not None:
+        code_points, outlines_checked = coverage
+        covered = [c for c in charset if ord(c) in code_points]
+    missing_chars: set[str] = set()
+    if covered and filter_by_hash:
+        missing_chars = set(charset) - set(covered)
+        print(f"filter {len(missing_chars)} characters missing from the cmap")
+    if covered and outlines_checked:
+        dst_offset = get_metric_font_offset(covered, dst_font, canvas_size)
+    else:
+        if covered:
+            print("no TrueType outlines to find empty glyphs, sampling rendered too")
+        elif use_cmap:
+            print("unreadable cmap, sampling rendered glyphs instead")
+        sample_chars = covered or charset
+        dst_filter_hashes = set(
+            filter_recurring_hash(sample_chars, dst_font, canvas_size, 0, 0)
+        )
+        dst_offset = get_font_offset(
+            sample_chars, dst_font, canvas_size, dst_filter_hashes
+        )
     print("Src font offset : ", [x_offset, y_offset])
     print("Dst font offset : ", dst_offset)
 
     filter_hashes: set[int] = set()
-    if filter_by_hash:
+    if filter_by_hash and not (covered and outlines_checked):
+        # blank placeholder glyphs can only be told apart once rendered
         filter_hashes = set(
             filter_recurring_hash(
-                charset, dst_font, canvas_size, dst_offset[0], dst_offset[1]
+                covered or charset,
+                dst_font,
+                canvas_size,
+                dst_offset[0],
+                dst_offset[1],
             )
         )
         print(f"filter hashes -> {','.join([str(h) for h in filter_hashes])}")
 
+    renderer = ExampleRenderer(
+        src,
+        dst,
+        char_size,
+        canvas_size,
+        (x_offset, y_offset),
+        (dst_offset[0], dst_offset[1]),
+        filter_hashes,
+        handwriting_dir,
+        glyph_cache,
+        writer.encoding,
+        backend,
+    )
+
+    def render(
+        chars: list[str], mode: str
+    ) -> Iterator[tuple[str, None | Encoded | Rendered]]:
+        if mode == "filtered" and missing_chars:
+            # missing glyphs would be dropped after rendering anyway
+            chars = [c for c in chars if c not in missing_chars]
+        if manifest is None:
+            yield from render_examples(
+                renderer, chars, mode, pool=pool, workers=workers
+            )
+            return
+
+        keys = [manifest.key(renderer, mode, c) for c in chars]
+        todo = [c for c, key in zip(chars, keys) if key and key not in manifest.entries]
+        print(f"{len(chars) - len(todo)} of {len(chars)} chars found in manifest")
+        rendered = render_examples(renderer, todo, mode, pool=pool, workers=workers)
+        for c, key in zip(chars, keys):
+            if key is None:
+                # no handwriting image for this character
+                yield c, None
+            elif key in manifest.entries:
+                yield c, Rendered(key, manifest.entries[key])
+            else:
+                _, e = next(rendered)
+                yield c, Rendered(key, None) if e is None else e
+                if e is None:
+                    manifest.record(key, None)
+
+    def write(
+        c: str, mode: str, code: str, split: str | None, e: Encoded | Rendered
+    ) -> None:
+        if manifest is None:
+            assert not isinstance(e, Rendered)
+            writer.write(label, code, split, e)
+            return
+        assert isinstance(writer, ImageDirWriter)
+        name = writer.name(label, code, split)
+        key = manifest.key(renderer, mode, c)
+        assert key is not None
+        if isinstance(e, Rendered):
+            if e.name == name and os.path.exists(os.path.join(writer.sample_dir, name)):
+                return
+            # recorded under another name, e.g. after a reshuffle
+            data = renderer.render(mode, c)
+            assert data is not None
+            e = data
+        writer.write(label, code, split, e)
+        manifest.record(key, name)
+
+    def rendered(e: None | Encoded | Rendered) -> bool:
+        if isinstance(e, Rendered):
+            return e.name is not None
+        return e is not None
+
     count = 0
 
     if handwriting_dir:
-        if not os.path.exists(sample_dir):
-            os.makedirs(sample_dir)
         train_set: list[str] = []
-        for c in charset:
-            e = draw_handwriting(
-                c, src_font, canvas_size, (x_offset, y_offset), handwriting_dir
-            )
-            if e is None:
+        for c, e in render(charset, "handwriting"):
+            if not rendered(e):
                 continue
-            character_unicode = (
-                c.encode("unicode-escape").decode("utf-8").replace("\\u", "").upper()
-            )
-            e.save(os.path.join(sample_dir, f"{label}_{character_unicode}_train.png"))
+            write(c, "handwriting", char_code(c), "train", e)
             train_set.append(c)
             count += 1
             if count % 100 == 0:
@@ -212,22 +925,10 @@ def font2img(
 
         np.random.shuffle(charset)
         count = 0
-        for c in charset:
-            e = draw_example(
-                c,
-                src_font,
-                dst_font,
-                canvas_size,
-                (x_offset, y_offset),
-                dst_offset,
-                filter_hashes=set(),
-            )
-            if e is None:
+        for c, e in render(charset, "unfiltered"):
+            if not rendered(e):
                 continue
-            character_unicode = (
-                c.encode("unicode-escape").decode("utf-8").replace("\\u", "").upper()
-            )
-            e.save(os.path.join(sample_dir, f"{label}_{character_unicode}_val.png"))
+            write(c, "unfiltered", char_code(c), "val", e)
             count += 1
             if count % 100 == 0:
                 print("processed %d chars" % count)
@@ -235,90 +936,177 @@ def font2img(
 
     if fixed_sample:
         train_set = select_sample(charset)
-        for c in train_set:
-            e = draw_example(
-                c,
-                src_font,
-                dst_font,
-                canvas_size,
-                (x_offset, y_offset),
-                dst_offset,
-                filter_hashes,
-            )
-            if e:
-                e.save(os.path.join(sample_dir, "%d_%04d_train.png" % (label, count)))
+        for c, e in render(train_set, "filtered"):
+            if rendered(e):
+                write(c, "filtered", char_code(c), "train", e)
                 count += 1
                 if count % 100 == 0:
                     print("processed %d chars" % count)
 
         np.random.shuffle(charset)
         count = 0
-        for c in charset:
+        val_set = [c for c in charset if c not in train_set]
+        for c, e in render(val_set, "unfiltered"):
             if count == sample_count:
                 break
-            if c in train_set:
-                continue
-            e = draw_example(
-                c,
-                src_font,
-                dst_font,
-                canvas_size,
-                (x_offset, y_offset),
-                dst_offset,
-                filter_hashes=set(),
-            )
-            if e is None:
+            if not rendered(e):
                 continue
-            e.save(os.path.join(sample_dir, f"{label}_{count:04}_val.png"))
+            write(c, "unfiltered", char_code(c), "val", e)
             count += 1
             if count % 100 == 0:
                 print(f"processed {count} chars")
         return
 
     if all_sample:
-        for c in charset:
-            e = draw_example(
-                c,
-                src_font,
-                dst_font,
-                canvas_size,
-                (x_offset, y_offset),
-                dst_offset,
-                filter_hashes,
-            )
-            if e:
-                e.save(os.path.join(sample_dir, f"{label}_{count:04}.png"))
+        for c, e in render(charset, "filtered"):
+            if rendered(e):
+                write(c, "filtered", char_code(c), None, e)
                 count += 1
                 if count % 1000 == 0:
                     print(f"processed {count} chars")
         return
 
-    for c in charset:
+    for c, e in render(charset, "filtered"):
         if count == sample_count:
             break
-        e = draw_example(
-            c,
-            src_font,
-            dst_font,
-            canvas_size,
-            (x_offset, y_offset),
-            dst_offset,
-            filter_hashes,
-        )
-        if e is None:
+        if not rendered(e):
             continue
-        e.save(os.path.join(sample_dir, f"{label}_{count:04}.png"))
+        write(c, "filtered", char_code(c), None, e)
         count += 1
         if count % 100 == 0:
             print(f"processed {count} chars")
 
 
+FONT_EXTENSIONS = (".ttf", ".otf", ".ttc")
+
+
+def find_fonts(dst_dirs: list[str], manifest: str | None = None) -> list[str]:
+    """
+    List the target fonts of a family build: font files under each directory
+    in sorted order, then the paths listed one per line in the manifest
+    """
+    fonts: list[str] = []
+    for dst_dir in dst_dirs:
+        found: list[str] = []
+        for root, _, files in os.walk(dst_dir):
+            for name in files:
+                if name.lower().endswith(FONT_EXTENSIONS):
+                    found.append(os.path.join(root, name))
+        fonts.extend(sorted(found))
+    if manifest:
+        base_dir = os.path.dirname(manifest)
+        with open(manifest) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    fonts.append(os.path.join(base_dir, line))
+    return fonts
+
+
+def font2img_family(
+    src: str,
+    dst_fonts: list[str],
+    charset: list[str],
+    char_size: int,
+    canvas_size: int,
+    x_offset: int,
+    y_offset: int,
+    sample_count: int,
+    sample_dir: str,
+    first_label: int = 0,
+    filter_by_hash: bool = True,
+    fixed_sample: bool = False,
+    all_sample: bool = False,
+    workers: int = 1,
+    glyph_cache: GlyphCache | None = None,
+    use_cmap: bool = True,
+    mapping_path: str | None = None,
+    save_dir: str | None = None,
+    train_val_split: float = 0.1,
+    resume: bool = False,
+    backend: str = "pil",
+    save_format: str = "pickle",
+    drop_duplicates: bool = False,
+) -> list[dict[str, int | str]]:
+    """
+    Render every target font against the same source font in one process
+    (and one worker pool), labelling fonts in order from first_label.
+    The label mapping is written as json to mapping_path.
+    With save_dir, examples go straight into its train.obj / val.obj
+    """
+    writer = (
+        DatasetWriter(save_dir, train_val_split, save_format, drop_duplicates)
+        if save_dir
+        else ImageDirWriter(sample_dir)
+    )
+    manifest = None
+    if resume and isinstance(writer, ImageDirWriter):
+        manifest = RenderManifest(os.path.join(sample_dir, "manifest.jsonl"))
+    mapping: list[dict[str, int | str]] = []
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        for i, dst in enumerate(dst_fonts):
+            label = first_label + i
+            print(f"[{i + 1}/{len(dst_fonts)}] label {label} : {dst}")
+            font2img(
+                src,
+                dst,
+                charset[:],
+                char_size,
+                canvas_size,
+                x_offset,
+                y_offset,
+                sample_count,
+                sample_dir,
+                label,
+                filter_by_hash,
+                fixed_sample,
+                all_sample,
+                workers=workers,
+                pool=pool,
+                glyph_cache=glyph_cache,
+                use_cmap=use_cmap,
+                writer=writer,
+                manifest=manifest,
+                backend=backend,
+            )
+            mapping.append({"label": label, "font": os.path.basename(dst), "path": dst})
+    finally:
+        writer.close()
+        if manifest is not None:
+            manifest.close()
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if mapping_path is None:
+        mapping_path = os.path.join(save_dir or sample_dir, "mapping.json")
+    with open(mapping_path, "w") as f:
+        json.dump({"src_font": src, "fonts": mapping}, f, indent=2)
+    return mapping
+
+
 @click.command()
 @click.option(
     "--src-font", type=click.Path(), required=True, help="path of source font"
 )
+@click.option("--dst-font", type=click.Path(), help="path of target font")
+@click.option(
+    "--dst-dir",
+    type=click.Path(exists=True, file_okay=False),
+    multiple=True,
+    help="directory of target fonts to render in one run, labelled from --label",
+)
 @click.option(
-    "--dst-font", type=click.Path(), required=True, help="path of target font"
+    "--manifest",
+    type=click.Path(exists=True, dir_okay=False),
+    help="file listing target font paths (one per line) to render in one run",
+)
+@click.option(
+    "--mapping",
+    type=click.Path(),
+    default=None,
+    help="where to write the label mapping of --dst-dir/--manifest runs (json)",
 )
 @click.option("--filter", type=int, default=0, help="filter recurring characters")
 @click.option(
@@ -351,9 +1139,67 @@ def font2img(
     default=False,
     help="pick handwriting samples (399 training set). Note that this should not be used with --shuffle.",
 )
+@click.option(
+    "--workers",
+    type=int,
+    default=1,
+    help="number of processes rendering examples in parallel",
+)
+@click.option(
+    "--save-dir",
+    type=click.Path(),
+    default=None,
+    help="write examples straight into train.obj/val.obj here instead of PNGs",
+)
+@click.option(
+    "--split-ratio",
+    type=float,
+    default=0.1,
+    help="split ratio between train and val, with --save-dir",
+)
+@click.option(
+    "--save-format",
+    type=click.Choice(DATASET_FORMATS),
+    default="pickle",
+    help="dataset format of train.obj/val.obj, with --save-dir",
+)
+@click.option(
+    "--drop-duplicates",
+    type=bool,
+    default=False,
+    help="drop examples with the same label and image as an earlier one, "
+    "with --save-dir",
+)
+@click.option(
+    "--resume",
+    type=bool,
+    default=False,
+    help="skip examples recorded in the manifest of sample-dir by a previous run",
+)
+@click.option(
+    "--backend",
+    type=click.Choice(["pil", "numpy"]),
+    default="pil",
+    help="compose examples as PIL images, or in place in preallocated arrays",
+)
+@click.option(
+    "--glyph-cache-dir",
+    type=click.Path(),
+    default=None,
+    help="directory to cache rendered source glyphs, shared across target fonts",
+)
+@click.option(
+    "--use-cmap",
+    type=bool,
+    default=True,
+    help="find missing characters from the font cmap instead of rendered samples",
+)
 def main(
     src_font: str,
-    dst_font: str,
+    dst_font: str | None,
+    dst_dir: tuple[str, ...],
+    manifest: str | None,
+    mapping: str | None,
     filter: bool,
     shuffle: bool,
     char_size: int,
@@ -366,6 +1212,15 @@ def main(
     fixed_sample: bool,
     all_sample: bool,
     handwriting_dir: Literal[False] | str,
+    workers: int,
+    save_dir: str | None,
+    split_ratio: float,
+    save_format: str,
+    drop_duplicates: bool,
+    resume: bool,
+    backend: str,
+    glyph_cache_dir: str | None,
+    use_cmap: bool,
 ):
     """
     Convert font to images
@@ -378,6 +1233,45 @@ def main(
         charset.append(chr(i))
     if shuffle:
         np.random.shuffle(charset)
+    glyph_cache = GlyphCache(glyph_cache_dir) if glyph_cache_dir else None
+
+    if dst_dir or manifest:
+        if handwriting_dir:
+            raise click.UsageError("--handwriting-dir renders a single target")
+        font2img_family(
+            src_font,
+            find_fonts(list(dst_dir), manifest),
+            charset,
+            char_size,
+            canvas_size,
+            x_offset,
+            y_offset,
+            sample_count,
+            sample_dir,
+            label,
+            filter,
+            fixed_sample,
+            all_sample,
+            workers,
+            glyph_cache,
+            use_cmap,
+            mapping,
+            save_dir,
+            split_ratio,
+            resume,
+            backend,
+            save_format,
+            drop_duplicates,
+        )
+        return
+    if dst_font is None:
+        raise click.UsageError("one of --dst-font, --dst-dir or --manifest is required")
+
+    writer = (
+        DatasetWriter(save_dir, split_ratio, save_format, drop_duplicates)
+        if save_dir
+        else None
+    )
     font2img(
         src_font,
         dst_font,
@@ -393,4 +1287,12 @@ def main(
         fixed_sample,
         all_sample,
         handwriting_dir,
+        workers,
+        glyph_cache=glyph_cache,
+        use_cmap=use_cmap,
+        writer=writer,
+        resume=resume,
+        backend=backend,
     )
+    if writer is not None:
+        writer.close()
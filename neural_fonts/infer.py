@@ -3,7 +3,7 @@ import os
 
 import tensorflow as tf
 
-from neural_fonts.model.unet import UNet
+from neural_fonts.model.unet import UNet, UNetTF2
 from neural_fonts.model.utils import compile_frames_to_gif
 
 """
@@ -94,40 +94,58 @@ parser.add_argument(
     default=None,
     help="Progress file name. Not used with compare",
 )
+parser.add_argument(
+    "--tf2",
+    dest="tf2",
+    type=int,
+    default=0,
+    help="infer with the TF2 model from the same checkpoints, not with interpolate",
+)
 args = parser.parse_args()
 
 
-def main(_):
-    config = tf.ConfigProto()
-    config.gpu_options.allow_growth = True
+def infer(model, embedding_ids):
+    if len(embedding_ids) == 1:
+        embedding_ids = embedding_ids[0]
+    if args.compare:
+        model.infer_compare(
+            model_dir=args.model_dir,
+            source_obj=args.source_obj,
+            embedding_ids=embedding_ids,
+            save_dir=args.save_dir,
+            show_ssim=args.show_ssim,
+        )
+    else:
+        model.infer(
+            model_dir=args.model_dir,
+            source_obj=args.source_obj,
+            embedding_ids=embedding_ids,
+            save_dir=args.save_dir,
+            progress_file=args.progress_file,
+        )
+
 
+def main(_=None):
     if not os.path.exists(args.save_dir):
         os.makedirs(args.save_dir)
 
+    embedding_ids = [int(i) for i in args.embedding_ids.split(",")]
+    if args.tf2:
+        if args.interpolate:
+            raise Exception("interpolate needs the graph model, run it without tf2")
+        model = UNetTF2(batch_size=args.batch_size, inst_norm=bool(args.inst_norm))
+        infer(model, embedding_ids)
+        return
+
+    config = tf.ConfigProto()
+    config.gpu_options.allow_growth = True
+
     with tf.Session(config=config) as sess:
         model = UNet(batch_size=args.batch_size)
         model.register_session(sess)
         model.build_model(is_training=False, inst_norm=args.inst_norm)
-        embedding_ids = [int(i) for i in args.embedding_ids.split(",")]
         if not args.interpolate:
-            if len(embedding_ids) == 1:
-                embedding_ids = embedding_ids[0]
-            if args.compare:
-                model.infer_compare(
-                    model_dir=args.model_dir,
-                    source_obj=args.source_obj,
-                    embedding_ids=embedding_ids,
-                    save_dir=args.save_dir,
-                    show_ssim=args.show_ssim,
-                )
-            else:
-                model.infer(
-                    model_dir=args.model_dir,
-                    source_obj=args.source_obj,
-                    embedding_ids=embedding_ids,
-                    save_dir=args.save_dir,
-                    progress_file=args.progress_file,
-                )
+            infer(model, embedding_ids)
         else:
             if len(embedding_ids) < 2:
                 raise Exception(
@@ -0,0 +1,87 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import tensorflow as tf
+
+
+class AsyncCheckpointer:
+    """
+    Drop-in for tf.train.Saver.save that does not block training: save
+    copies the variable values out, and a background thread writes them
+    through a saver of shadow variables with the same names, in a graph
+    of its own. Files, names and retention are those of a Saver of the
+    variables. At most one save is written while the next is taken
+    """
+
+    def __init__(self, variables, max_to_keep=3):
+        # name -> variable, graph variables read through the session
+        # given to save, eager ones directly
+        self.names = list(variables)
+        self.variables = [variables[name] for name in self.names]
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.values = []
+            shadows = {}
+            for name, var in zip(self.names, self.variables):
+                dtype = var.dtype.base_dtype
+                self.values.append(tf.compat.v1.placeholder(dtype, var.shape))
+                shadows[name] = tf.compat.v1.Variable(
+                    tf.zeros(var.shape, dtype=dtype), name=name
+                )
+            self.assign = tf.group(
+                *[shadows[name].assign(v) for name, v in zip(self.names, self.values)]
+            )
+            self.saver = tf.compat.v1.train.Saver(
+                var_list=shadows, max_to_keep=max_to_keep
+            )
+        self.session = tf.compat.v1.Session(graph=self.graph)
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = None
+
+    def snapshot(self, sess=None):
+        """
+        Current values of the variables
+        """
+        if sess is not None:
+            return sess.run(self.variables)
+        return [var.numpy() for var in self.variables]
+
+    def save(self, sess, save_path, global_step=None, on_saved=None):
+        """
+        Snapshot the variables and write them in the background.
+        on_saved is called with the checkpoint path once it is written
+        """
+        values = self.snapshot(sess)
+        self.wait()
+        self.pending = self.executor.submit(
+            self._write, values, save_path, global_step, on_saved
+        )
+
+    def _write(self, values, save_path, global_step, on_saved):
+        # default graphs are per thread, eager execution is not
+        with self.graph.as_default():
+            self.session.run(self.assign, feed_dict=dict(zip(self.values, values)))
+            path = self.saver.save(
+                self.session,
+                save_path,
+                global_step=global_step,
+                write_meta_graph=False,
+            )
+        if on_saved is not None:
+            on_saved(path)
+        return path
+
+    def wait(self):
+        """
+        Block until the last save is written, raising its error if it failed
+        """
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            return pending.result()
+        return None
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown()
+            self.session.close()
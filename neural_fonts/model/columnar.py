@@ -0,0 +1,291 @@
+import hashlib
+import json
+import shutil
+import struct
+import tempfile
+from collections.abc import Sequence
+from typing import NamedTuple
+
+import numpy as np
+
+# Columnar dataset layout
+#   preamble  : magic, footer offset (padded to ALIGNMENT)
+#   images    : uint8 [image count, height, width * depth / 8], distinct
+#               target | source pairs, quantized to depth bits and packed
+#               along the width
+#   labels    : int32 [count]
+#   codes     : int32 [count], index into the code table
+#   refs      : int32 [count], index into the images
+#   edges     : only with exact edges, the pixels quantization changed
+#               - starts    int64 [image count + 1], range of each image
+#               - positions uint16/uint32, flat pixel index in the image
+#               - values    uint8, exact pixel value
+#   footer    : json with shapes, offsets and the code table
+# Every array starts on an ALIGNMENT boundary so it can be memory mapped
+MAGIC = b"NFCOLS01"
+PREAMBLE = struct.Struct("<8sQ")
+ALIGNMENT = 64
+BIT_DEPTHS = [8, 4, 2, 1]
+
+
+def is_columnar(path) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def position_dtype(image_shape) -> str:
+    return "<u2" if np.prod(image_shape) <= 1 << 16 else "<u4"
+
+
+def quantize(images, depth):
+    """
+    Round uint8 pixels to depth bits, and pack them along the last axis
+    """
+    if depth == 8:
+        return images
+    levels = (1 << depth) - 1
+    q = (images.astype(np.uint16) * levels + 127) // 255
+    if depth == 1:
+        return np.packbits(q.astype(np.uint8), axis=-1)
+    per_byte = 8 // depth
+    q = q.reshape(*q.shape[:-1], q.shape[-1] // per_byte, per_byte)
+    shifts = 8 - depth * np.arange(1, per_byte + 1, dtype=np.uint16)
+    return (q << shifts).sum(axis=-1).astype(np.uint8)
+
+
+def dequantize(packed, depth):
+    """
+    Unpack depth bit pixels along the last axis back to uint8
+    """
+    if depth == 8:
+        return np.asarray(packed)
+    if depth == 1:
+        return np.unpackbits(packed, axis=-1) * np.uint8(255)
+    levels = (1 << depth) - 1
+    per_byte = 8 // depth
+    shifts = 8 - depth * np.arange(1, per_byte + 1, dtype=np.uint8)
+    q = (packed[..., None] >> shifts) & np.uint8(levels)
+    q = q.reshape(*packed.shape[:-1], packed.shape[-1] * per_byte)
+    return q * np.uint8(255 // levels)
+
+
+class ColumnarWriter:
+    """
+    Stream examples into a columnar dataset file. Images are written as
+    they come, labels and codes are kept in memory until close.
+    Without image_shape, the first image fixes the shape of all others.
+    Identical images are stored once and referenced by every example.
+    Below 8 bits, exact_edges keeps the exact value of every pixel the
+    quantization changed, i.e. the anti-aliased outline of the glyphs
+    """
+
+    def __init__(self, path, image_shape=None, depth=8, exact_edges=False):
+        if depth not in BIT_DEPTHS:
+            raise ValueError("unsupported bit depth %d" % depth)
+        self.path = path
+        self.image_shape = tuple(image_shape) if image_shape else None
+        self.depth = depth
+        self.exact_edges = exact_edges and depth < 8
+        self.labels: list[int] = []
+        self.codes: list[int] = []
+        self.code_table: dict[str, int] = {}
+        self.refs: list[int] = []
+        self.image_rows: dict[bytes, int] = {}
+        self.edge_counts: list[int] = []
+        self.edge_positions = tempfile.TemporaryFile()
+        self.edge_values = tempfile.TemporaryFile()
+        self.file = open(path, "wb")
+        self.file.write(b"\0" * ALIGNMENT)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, label, code, image, digest=None):
+        """
+        Append an example, digest is the content hash of image when the
+        caller already has one
+        """
+        image = np.ascontiguousarray(image, dtype=np.uint8)
+        if self.image_shape is None:
+            self.image_shape = image.shape
+        if image.shape != self.image_shape:
+            raise ValueError(
+                "image shape %s, expected %s" % (image.shape, self.image_shape)
+            )
+        if image.shape[-1] * self.depth % 8:
+            raise ValueError("image width does not fill whole bytes")
+        if digest is None:
+            digest = hashlib.blake2b(image, digest_size=16).digest()
+        if digest not in self.image_rows:
+            self.image_rows[digest] = len(self.image_rows)
+            self._write_image(image)
+        self.refs.append(self.image_rows[digest])
+        self.labels.append(int(label))
+        self.codes.append(self.code_table.setdefault(str(code), len(self.code_table)))
+
+    def _write_image(self, image):
+        packed = quantize(image, self.depth)
+        self.file.write(packed.tobytes())
+        if self.exact_edges:
+            changed = np.flatnonzero(dequantize(packed, self.depth) != image)
+            positions = changed.astype(position_dtype(self.image_shape))
+            self.edge_positions.write(positions.tobytes())
+            self.edge_values.write(image.ravel()[changed].tobytes())
+            self.edge_counts.append(len(changed))
+
+    def _align(self):
+        padding = -self.file.tell() % ALIGNMENT
+        self.file.write(b"\0" * padding)
+        return self.file.tell()
+
+    def _write_edges(self, footer):
+        footer["edge_starts_offset"] = self._align()
+        starts = np.cumsum([0] + self.edge_counts, dtype="<i8")
+        self.file.write(starts.tobytes())
+        for name, f in [
+            ("positions", self.edge_positions),
+            ("values", self.edge_values),
+        ]:
+            footer["edge_%s_offset" % name] = self._align()
+            f.seek(0)
+            shutil.copyfileobj(f, self.file)
+
+    def close(self):
+        if self.file.closed:
+            return
+        footer = {
+            "count": len(self.labels),
+            "image_count": len(self.image_rows),
+            "image_shape": list(self.image_shape or (0, 0)),
+            "depth": self.depth,
+            "exact_edges": self.exact_edges,
+            "images_offset": ALIGNMENT,
+        }
+        footer["labels_offset"] = self._align()
+        self.file.write(np.asarray(self.labels, dtype="<i4").tobytes())
+        footer["codes_offset"] = self._align()
+        self.file.write(np.asarray(self.codes, dtype="<i4").tobytes())
+        footer["refs_offset"] = self._align()
+        self.file.write(np.asarray(self.refs, dtype="<i4").tobytes())
+        if self.exact_edges:
+            self._write_edges(footer)
+        self.edge_positions.close()
+        self.edge_values.close()
+        footer_offset = self._align()
+        footer["code_table"] = sorted(self.code_table, key=self.code_table.__getitem__)
+        self.file.write(json.dumps(footer).encode("utf-8"))
+        self.file.seek(0)
+        self.file.write(PREAMBLE.pack(MAGIC, footer_offset))
+        self.file.close()
+
+
+class PackedImage(NamedTuple):
+    """
+    Reference to a quantized image, unpacked along with the rest of
+    its batch by ColumnarImageProvider.unpack
+    """
+
+    provider: "ColumnarImageProvider"
+    index: int
+
+    def unpack(self):
+        return self.provider.unpack([self.index])[0]
+
+
+class ColumnarExamples(Sequence):
+    """
+    (label, code, image) view over a columnar dataset, the same shape as
+    the pickled example list. Images are zero-copy rows of the memory map,
+    or PackedImage references when they are quantized
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def __len__(self):
+        return len(self.provider.labels)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        p = self.provider
+        row = int(p.refs[i])
+        image = p.images[row] if p.depth == 8 else PackedImage(p, row)
+        return int(p.labels[i]), p.code_table[p.codes[i]], image
+
+
+class ColumnarImageProvider:
+    """
+    Memory map a columnar dataset. Processes opening the same file share
+    its pages through the page cache instead of each unpickling a copy
+    """
+
+    def __init__(self, obj_path):
+        self.obj_path = obj_path
+        with open(obj_path, "rb") as f:
+            magic, footer_offset = PREAMBLE.unpack(f.read(PREAMBLE.size))
+            if magic != MAGIC:
+                raise ValueError("%s is not a columnar dataset" % obj_path)
+            f.seek(footer_offset)
+            footer = json.loads(f.read().decode("utf-8"))
+        count = footer["count"]
+        image_count = footer.get("image_count", count)
+        self.image_shape = tuple(footer["image_shape"])
+        self.depth = footer.get("depth", 8)
+        height, width = self.image_shape
+        self.images = self._map(
+            footer["images_offset"],
+            np.uint8,
+            (image_count, height, width * self.depth // 8),
+        )
+        self.labels = self._map(footer["labels_offset"], "<i4", (count,))
+        self.codes = self._map(footer["codes_offset"], "<i4", (count,))
+        if "refs_offset" in footer:
+            self.refs = self._map(footer["refs_offset"], "<i4", (count,))
+        else:
+            self.refs = np.arange(count, dtype=np.int32)
+        self.edge_starts = None
+        if footer.get("exact_edges"):
+            self.edge_starts = self._map(
+                footer["edge_starts_offset"], "<i8", (image_count + 1,)
+            )
+            total = int(self.edge_starts[-1])
+            self.edge_positions = self._map(
+                footer["edge_positions_offset"],
+                position_dtype(self.image_shape),
+                (total,),
+            )
+            self.edge_values = self._map(
+                footer["edge_values_offset"], np.uint8, (total,)
+            )
+        self.code_table = footer["code_table"]
+        self.examples = ColumnarExamples(self)
+        print("mapped total %d examples, %d distinct images" % (count, image_count))
+
+    def _map(self, offset, dtype, shape):
+        if not np.prod(shape):
+            # mmap refuses empty ranges
+            return np.empty(shape, dtype=dtype)
+        return np.memmap(
+            self.obj_path, dtype=dtype, mode="r", offset=offset, shape=shape
+        )
+
+    def unpack(self, indices):
+        """
+        uint8 images at indices of the image rows, unpacked in one go
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        images = dequantize(self.images[indices], self.depth)
+        if self.edge_starts is not None:
+            starts = self.edge_starts[indices]
+            counts = self.edge_starts[indices + 1] - starts
+            # position of every edge pixel of the selected examples in the table
+            first = np.cumsum(counts) - counts
+            gather = np.arange(counts.sum()) + np.repeat(starts - first, counts)
+            rows = np.repeat(np.arange(len(indices)), counts)
+            flat = images.reshape(len(indices), -1)
+            flat[rows, self.edge_positions[gather]] = self.edge_values[gather]
+        return images
@@ -1,15 +1,31 @@
+import collections
+import itertools
 import os
 import pickle
 import random
+from collections.abc import Sequence
 
 import numpy as np
 
+from neural_fonts.model.columnar import (
+    ColumnarExamples,
+    ColumnarImageProvider,
+    PackedImage,
+    is_columnar,
+)
+from neural_fonts.model.indexed import IndexedExamples, IndexedImageProvider
+from neural_fonts.model.prefetch import WaitTimer, prefetch
+from neural_fonts.model.sharded import (
+    ShardedExamples,
+    ShardedImageProvider,
+    is_sharded,
+)
 from neural_fonts.model.utils import (
     bytes_to_file,
     normalize_image,
-    pad_seq,
-    read_split_image,
-    shift_and_resize_image,
+    read_image,
+    shift_and_resize_batch,
+    split_image,
 )
 
 
@@ -23,6 +39,7 @@ class PickledImageProvider:
     def load_pickled_examples(self):
         with open(self.obj_path, "rb") as of:
             examples = list()
+            skipped = 0
             while True:
                 try:
                     e = pickle.load(of)
@@ -32,52 +49,244 @@ class PickledImageProvider:
                 except EOFError:
                     break
                 except Exception:
-                    pass
+                    skipped += 1
+            if skipped:
+                print("skipped %d unreadable records" % skipped)
             print("unpickled total %d examples" % len(examples))
             return examples
 
 
-def get_batch_iter(examples, batch_size, augment):
+# providers that filter labels through an index instead of their examples
+INDEXED_PROVIDERS = (ShardedImageProvider, IndexedImageProvider)
+
+
+def load_image_provider(obj_path, lazy=False):
+    """
+    Open a dataset file, memory mapped when it is in the columnar format
+    and streamed from its shards when it is a sharded index.
+    With lazy, pickled files are read record by record through an offset
+    index instead of unpickled in full
+    """
+    if is_columnar(obj_path):
+        return ColumnarImageProvider(obj_path)
+    if is_sharded(obj_path):
+        return ShardedImageProvider(obj_path)
+    if lazy:
+        return IndexedImageProvider(obj_path)
+    return PickledImageProvider(obj_path)
+
+
+class ExampleView(Sequence):
+    """
+    The examples at positions of an example sequence, without copying them
+    """
+
+    def __init__(self, examples, positions):
+        self.examples = examples
+        self.positions = np.asarray(positions, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.examples[j] for j in self.positions[i].tolist()]
+        return self.examples[int(self.positions[i])]
+
+
+def example_labels(examples):
+    """
+    Labels of a sequence of examples, from the index or columns of the
+    dataset where it has one
+    """
+    if isinstance(examples, ExampleView):
+        return example_labels(examples.examples)[examples.positions]
+    if isinstance(examples, ColumnarExamples):
+        return np.asarray(examples.provider.labels)
+    if isinstance(examples, (ShardedExamples, IndexedExamples)):
+        return examples.provider.index["label"]
+    return np.array([e[0] for e in examples], dtype=np.int64)
+
+
+class LabelIndex:
+    """
+    Positions of the examples of every label, grouped by label
+    """
+
+    def __init__(self, labels):
+        labels = np.asarray(labels)
+        self.order = np.argsort(labels, kind="stable")
+        self.labels, self.starts, self.counts = np.unique(
+            labels[self.order], return_index=True, return_counts=True
+        )
+
+    def positions(self, labels):
+        """
+        Positions of the examples of the given labels, in time linear to
+        their number
+        """
+        found = np.searchsorted(self.labels, sorted(labels))
+        found = found[found < len(self.labels)]
+        found = found[np.isin(self.labels[found], list(labels))]
+        return np.concatenate(
+            [
+                self.order[self.starts[i] : self.starts[i] + self.counts[i]]
+                for i in found
+            ]
+            or [np.empty(0, dtype=np.int64)]
+        )
+
+    def sample(self, size, balance=1.0, rng=np.random):
+        """
+        Draw size example positions, picking labels with probability
+        proportional to count ** (1 - balance): every label alike with
+        balance 1, as often as they occur with 0
+        """
+        weights = self.counts.astype(np.float64) ** (1.0 - balance)
+        labels = rng.choice(len(self.labels), size=size, p=weights / weights.sum())
+        offsets = (rng.random_sample(size) * self.counts[labels]).astype(np.int64)
+        return self.order[self.starts[labels] + offsets]
+
+
+def select_labels(provider, labels):
+    """
+    Narrow a provider to the examples of labels, as a view when it has
+    no index of its own
+    """
+    if isinstance(provider, INDEXED_PROVIDERS):
+        provider.select(labels)
+    else:
+        positions = LabelIndex(example_labels(provider.examples)).positions(labels)
+        provider.examples = ExampleView(provider.examples, positions)
+
+
+def decode_image(img):
+    """
+    uint8 image of an example payload. Payloads are PNG bytes, uint8 arrays
+    written by font2img --save-dir, or quantized images of a columnar dataset
+    """
+    if isinstance(img, PackedImage):
+        return img.unpack()
+    if isinstance(img, np.ndarray):
+        return img
+    with bytes_to_file(img) as f:
+        return read_image(f)
+
+
+def read_example(img):
+    """
+    Split an example payload into target and source images
+    """
+    return split_image(decode_image(img).astype(np.float32))
+
+
+def decode_examples(examples, budget):
+    """
+    Decode the payloads of examples once into a uint8 store of at most
+    budget bytes, examples past the budget keep their payload and are
+    decoded on demand. Payloads that are already arrays are left as is.
+    Returns the examples and the bytes used
+    """
+    examples = list(examples)
+    pending = [i for i, e in enumerate(examples) if not isinstance(e[2], np.ndarray)]
+    if not pending or budget <= 0:
+        return examples, 0
+    first = decode_image(examples[pending[0]][2])
+    capacity = min(len(pending), budget // first.nbytes)
+    store = np.empty((capacity, *first.shape), dtype=np.uint8)
+    # examples sharing a payload share its row
+    rows = {}
+    for i in pending:
+        label, code, img = examples[i]
+        if img not in rows:
+            if len(rows) == capacity:
+                continue
+            image = decode_image(img)
+            if image.shape != first.shape:
+                continue
+            rows[img] = len(rows)
+            store[rows[img]] = image
+        examples[i] = (label, code, store[rows[img]])
+    used = len(rows) * first.nbytes
+    print(
+        "decoded %d of %d payloads into %.1f MB"
+        % (len(rows), len(pending), used / 2**20)
+    )
+    return examples, used
+
+
+def augment_batch(pairs, rng=np.random):
+    """
+    augment a (batch, w, h, 2) batch of image pairs by:
+    1) enlarge every image by its own random factor
+    2) random crop it back to its original size
+    NOTE: image A and B are channels of the same pair, so they are
+    always shifted in sync
+    """
+    batch, w, h, _ = pairs.shape
+    multiplier = rng.uniform(1.00, 1.20, batch)
+    # add an eps to prevent cropping issue
+    nw = (multiplier * w).astype(np.intp) + 1
+    nh = (multiplier * h).astype(np.intp) + 1
+    shift_x = np.ceil(rng.uniform(0.01, nw - w)).astype(np.intp)
+    shift_y = np.ceil(rng.uniform(0.01, nh - h)).astype(np.intp)
+    return shift_and_resize_batch(pairs, shift_x, shift_y, nw, nh)
+
+
+def unpack_batch(payloads):
+    """
+    Unpack the quantized images of a batch with one call per dataset
+    """
+    payloads = list(payloads)
+    packed = collections.defaultdict(list)
+    for i, img in enumerate(payloads):
+        if isinstance(img, PackedImage):
+            packed[img.provider].append(i)
+    for provider, positions in packed.items():
+        images = provider.unpack([payloads[i].index for i in positions])
+        for i, image in zip(positions, images):
+            payloads[i] = image
+    return payloads
+
+
+def make_batch(batch, augment, rng=np.random):
+    labels = [e[0] for e in batch]
+    codes = [e[1] for e in batch]
+    images = np.stack([decode_image(img) for img in unpack_batch(e[2] for e in batch)])
+    side = images.shape[2] // 2
+    # (batch, w, h, 2) pairs of target and source
+    pairs = np.stack((images[:, :, :side], images[:, :, side:]), axis=3)
+    if augment:
+        pairs = augment_batch(pairs, rng)
+    return labels, codes, normalize_image(pairs.astype(np.float32))
+
+
+def batch_examples(examples, batch_size):
     # the transpose ops requires deterministic
-    # batch size, thus comes the padding
-    padded = pad_seq(examples, batch_size)
-
-    def process(img):
-        img = bytes_to_file(img)
-        try:
-            img_A, img_B = read_split_image(img)
-            if augment:
-                # augment the image by:
-                # 1) enlarge the image
-                # 2) random crop the image back to its original size
-                # NOTE: image A and B needs to be in sync as how much
-                # to be shifted
-                #                w, h, _ = img_A.shape
-                w, h = img_A.shape
-                multiplier = random.uniform(1.00, 1.20)
-                # add an eps to prevent cropping issue
-                nw = int(multiplier * w) + 1
-                nh = int(multiplier * h) + 1
-                shift_x = int(np.ceil(np.random.uniform(0.01, nw - w)))
-                shift_y = int(np.ceil(np.random.uniform(0.01, nh - h)))
-                img_A = shift_and_resize_image(img_A, shift_x, shift_y, nw, nh)
-                img_B = shift_and_resize_image(img_B, shift_x, shift_y, nw, nh)
-            img_A = normalize_image(img_A).reshape((128, 128, 1))
-            img_B = normalize_image(img_B).reshape((128, 128, 1))
-            return np.concatenate((img_A, img_B), axis=2)
-        finally:
-            img.close()
-
-    def batch_iter():
-        for i in range(0, len(padded), batch_size):
-            batch = padded[i : i + batch_size]
-            labels = [e[0] for e in batch]
-            codes = [e[1] for e in batch]
-            processed = [process(e[2]) for e in batch]
-            # stack into tensor
-            yield labels, codes, np.array(processed).astype(np.float32)
-
-    return batch_iter()
+    # batch size, thus comes the padding.
+    # Batches are sliced one at a time, lazy sequences are read as they go
+    for i in range(0, len(examples), batch_size):
+        batch = examples[i : i + batch_size]
+        yield batch + examples[: batch_size - len(batch)]
+
+
+def stream_batch_examples(examples, batch_size):
+    """
+    Batch an iterator of examples without holding more than one batch,
+    the last batch is padded with its own examples
+    """
+    batch = []
+    for e in examples:
+        batch.append(e)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield (batch * batch_size)[:batch_size]
+
+
+def get_batch_iter(examples, batch_size, augment):
+    return (make_batch(b, augment) for b in batch_examples(examples, batch_size))
 
 
 class TrainDataProvider:
@@ -88,23 +297,46 @@ class TrainDataProvider:
         val_name="val.obj",
         filter_by=None,
         no_val=False,
+        decode_budget=0,
+        prefetch_depth=0,
+        prefetch_workers=1,
+        balance=None,
+        seed=None,
+        shard=(0, 1),
     ):
         self.data_dir = data_dir
         self.filter_by = filter_by
+        self.balance = balance
+        self.prefetch_depth = prefetch_depth
+        self.prefetch_workers = prefetch_workers
+        # training shuffles and augmentation are drawn from generators seeded
+        # by (seed, epoch, batch), so any batch can be reproduced on resume
+        self.seed = np.random.randint(2**31) if seed is None else seed
+        # (index, count): with data parallel workers sharing the seed, each
+        # trains on every count-th batch of the same epoch, from index on
+        self.shard_index, self.shard_count = shard
+        # time the trainer spent waiting for training and validation batches
+        self.data_wait = WaitTimer()
+        self.val_wait = WaitTimer()
         self.train_path = os.path.join(self.data_dir, train_name)
         self.val_path = os.path.join(self.data_dir, val_name)
-        self.train = PickledImageProvider(self.train_path)
+        # only the records of the filtered labels are read
+        lazy = bool(filter_by)
+        self.train = load_image_provider(self.train_path, lazy)
         if not no_val:
-            self.val = PickledImageProvider(self.val_path)
+            self.val = load_image_provider(self.val_path, lazy)
         if self.filter_by:
             print("filter by label ->", filter_by)
-            self.train.examples = filter(
-                lambda e: e[0] in self.filter_by, self.train.examples
-            )
+            select_labels(self.train, self.filter_by)
             if not no_val:
-                self.val.examples = filter(
-                    lambda e: e[0] in self.filter_by, self.val.examples
-                )
+                select_labels(self.val, self.filter_by)
+        if decode_budget:
+            self.decode(decode_budget, no_val)
+        self.label_index = None
+        if not isinstance(self.train, ShardedImageProvider):
+            self.label_index = LabelIndex(example_labels(self.train.examples))
+        elif balance is not None:
+            print("sharded examples are streamed, labels are not balanced")
         if not no_val:
             print(
                 "train examples -> %d, val examples -> %d"
@@ -113,58 +345,170 @@ class TrainDataProvider:
         else:
             print("train examples -> %d" % (len(self.train.examples)))
 
-    def get_train_iter(self, batch_size, shuffle=True):
-        training_examples = self.train.examples[:]
-        if shuffle:
-            np.random.shuffle(training_examples)
-        return get_batch_iter(training_examples, batch_size, augment=True)
+    def decode(self, budget, no_val=False):
+        """
+        Decode examples once instead of every epoch, training examples
+        first, within budget bytes
+        """
+        providers = [self.train] if no_val else [self.train, self.val]
+        for provider in providers:
+            if isinstance(provider, ShardedImageProvider):
+                print("sharded examples are streamed, not decoded ahead")
+                continue
+            provider.examples, used = decode_examples(provider.examples, budget)
+            budget -= used
+
+    def prefetch(self, batches, augment, rngs=None, wait=None):
+        """
+        Decode batches ahead, augmented with the generator of the same
+        position in rngs when given. Waits are timed by wait, data_wait
+        by default
+        """
+
+        def make(item):
+            if rngs is None:
+                return make_batch(item, augment)
+            batch, rng = item
+            return make_batch(batch, augment, rng)
+
+        if rngs is not None:
+            batches = zip(batches, rngs)
+        return prefetch(
+            batches,
+            make,
+            depth=self.prefetch_depth,
+            workers=self.prefetch_workers,
+            wait=self.data_wait if wait is None else wait,
+        )
+
+    def epoch_rng(self, epoch, *stream):
+        return np.random.RandomState([self.seed, epoch, *stream])
+
+    def augment_rngs(self, epoch, start=0):
+        """
+        Augmentation generator of every batch of epoch from start on
+        """
+        return (
+            self.epoch_rng(epoch, i * self.shard_count + self.shard_index)
+            for i in itertools.count(start)
+        )
+
+    def get_train_iter(self, batch_size, shuffle=True, epoch=0, start=0):
+        """
+        Batches of epoch from the start-th on, the same ones every time
+        """
+        return self.prefetch(
+            self.train_batches(batch_size, shuffle, epoch, start),
+            augment=True,
+            rngs=self.augment_rngs(epoch, start),
+        )
+
+    def train_batches(self, batch_size, shuffle=True, epoch=0, start=0):
+        """
+        Batches of undecoded examples of epoch, skipping the first start
+        """
+        rng = self.epoch_rng(epoch)
+        if isinstance(self.train, ShardedImageProvider):
+            examples = self.train.stream(shuffle, rng=rng)
+            batches = stream_batch_examples(examples, batch_size)
+        elif self.balance is not None:
+            batches = self.balanced_batches(batch_size, rng)
+        else:
+            training_examples = self.train.examples[:]
+            if shuffle:
+                rng.shuffle(training_examples)
+            batches = batch_examples(training_examples, batch_size)
+        if self.shard_count > 1:
+            # every shard gets as many batches, so workers step in lockstep
+            end = self.compute_shard_batch_num(batch_size) * self.shard_count
+            batches = itertools.islice(batches, self.shard_index, end, self.shard_count)
+        return itertools.islice(batches, start, None)
+
+    def balanced_batches(self, batch_size, rng=np.random):
+        """
+        An epoch worth of batches with labels drawn by LabelIndex.sample,
+        referencing the examples instead of copying them
+        """
+        examples = self.train.examples
+        size = self.compute_total_batch_num(batch_size) * batch_size
+        positions = self.label_index.sample(size, self.balance, rng).tolist()
+        for i in range(0, size, batch_size):
+            yield [examples[j] for j in positions[i : i + batch_size]]
 
     def get_val_iter(self, batch_size, shuffle=True):
         """
         Validation iterator runs forever
         """
+        return self.prefetch(
+            self.val_batches(batch_size, shuffle), augment=False, wait=self.val_wait
+        )
+
+    def get_fixed_val_iter(self, batch_size, batch_num=1):
+        """
+        Validation iterator cycling forever over batch_num batches of the
+        same examples, decoded once. The examples are a seeded sample of
+        the validation set, so they stay the same across runs. Samples show
+        the same glyphs every batch_num calls, every call with one batch
+        """
+        examples = self.val.examples
+        count = min(len(examples), batch_size * batch_num)
+        positions = np.random.RandomState(0).permutation(len(examples))[:count]
+        fixed = [examples[i] for i in np.sort(positions).tolist()]
+        batches = [
+            make_batch(b, augment=False) for b in batch_examples(fixed, batch_size)
+        ]
+        print("fixed validation set -> %d batches" % len(batches))
+        return itertools.cycle(batches)
+
+    def val_batches(self, batch_size, shuffle=True):
+        if isinstance(self.val, ShardedImageProvider):
+            while True:
+                yield from stream_batch_examples(self.val.stream(shuffle), batch_size)
         val_examples = self.val.examples[:]
         if shuffle:
             np.random.shuffle(val_examples)
         while True:
-            val_batch_iter = get_batch_iter(val_examples, batch_size, augment=False)
-            for labels, codes, examples in val_batch_iter:
-                yield labels, codes, examples
+            yield from batch_examples(val_examples, batch_size)
 
     def compute_total_batch_num(self, batch_size):
         """Total padded batch num"""
         return int(np.ceil(len(self.train.examples) / float(batch_size)))
 
+    def compute_shard_batch_num(self, batch_size):
+        """Batch num of each shard, the remainder is left out"""
+        return self.compute_total_batch_num(batch_size) // self.shard_count
+
     def get_all_labels(self):
         """Get all training labels"""
-        return list({e[0] for e in self.train.examples})
+        if self.label_index is None:
+            return np.unique(self.train.labels).tolist()
+        return self.label_index.labels.tolist()
 
     def get_train_val_path(self):
         return self.train_path, self.val_path
 
 
 class InjectDataProvider:
-    def __init__(self, obj_path, filter_by=None):
+    def __init__(self, obj_path, filter_by=None, decode_budget=0):
         self.filter_by = filter_by
-        self.data = PickledImageProvider(obj_path)
+        # pickled sources are read record by record, not loaded in full
+        self.data = load_image_provider(obj_path, lazy=True)
         if self.filter_by:
             print("filter by label ->", filter_by)
-            self.data.examples = filter(
-                lambda e: e[0] in self.filter_by, self.data.examples
-            )
+            select_labels(self.data, self.filter_by)
+        if decode_budget:
+            self.data.examples, _ = decode_examples(self.data.examples, decode_budget)
         print("examples -> %d" % len(self.data.examples))
 
     def get_single_embedding_iter(self, batch_size, embedding_id):
-        examples = self.data.examples[:]
-        batch_iter = get_batch_iter(examples, batch_size, augment=False)
+        batch_iter = get_batch_iter(self.data.examples, batch_size, augment=False)
         for _, codes, images in batch_iter:
             # inject specific embedding style here
             labels = [embedding_id] * batch_size
             yield labels, codes, images
 
     def get_random_embedding_iter(self, batch_size, embedding_ids):
-        examples = self.data.examples[:]
-        batch_iter = get_batch_iter(examples, batch_size, augment=False)
+        batch_iter = get_batch_iter(self.data.examples, batch_size, augment=False)
         for _, codes, images in batch_iter:
             # inject specific embedding style here
             labels = [random.choice(embedding_ids) for i in range(batch_size)]
@@ -172,8 +516,10 @@ class InjectDataProvider:
 
 
 class NeverEndingLoopingProvider(InjectDataProvider):
-    def __init__(self, obj_path):
-        super(NeverEndingLoopingProvider, self).__init__(obj_path)
+    def __init__(self, obj_path, decode_budget=0):
+        super(NeverEndingLoopingProvider, self).__init__(
+            obj_path, decode_budget=decode_budget
+        )
 
     def get_random_embedding_iter(self, batch_size, embedding_ids):
         while True:
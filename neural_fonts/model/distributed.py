@@ -0,0 +1,80 @@
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+
+
+def free_ports(count) -> list[int]:
+    sockets = [socket.socket() for _ in range(count)]
+    try:
+        for s in sockets:
+            s.bind(("localhost", 0))
+        return [s.getsockname()[1] for s in sockets]
+    finally:
+        for s in sockets:
+            s.close()
+
+
+def tf_config(ports, index) -> str:
+    """
+    TF_CONFIG of worker index of a cluster on localhost
+    """
+    return json.dumps(
+        {
+            "cluster": {"worker": ["localhost:%d" % port for port in ports]},
+            "task": {"type": "worker", "index": index},
+        }
+    )
+
+
+def worker_info() -> tuple[int, int] | None:
+    """
+    (index, count) of this worker from TF_CONFIG, None outside a cluster
+    """
+    config = os.environ.get("TF_CONFIG")
+    if not config:
+        return None
+    config = json.loads(config)
+    return config["task"]["index"], len(config["cluster"]["worker"])
+
+
+def launch_workers(count, argv) -> int:
+    """
+    Run argv as count worker processes of a localhost cluster, each with
+    its share of the cores. Returns the first failing exit code, or 0
+    """
+    ports = free_ports(count)
+    threads = max(1, (os.cpu_count() or 1) // count)
+    workers = []
+    for index in range(count):
+        env = dict(
+            os.environ,
+            TF_CONFIG=tf_config(ports, index),
+            TF_NUM_INTRAOP_THREADS=str(threads),
+            OMP_NUM_THREADS=str(threads),
+        )
+        workers.append(subprocess.Popen([sys.executable] + argv, env=env))
+    print("launched %d workers on ports %s" % (count, ports))
+
+    def forward(signum, frame):
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signum)
+
+    previous = signal.signal(signal.SIGTERM, forward)
+    try:
+        codes = []
+        for worker in workers:
+            try:
+                codes.append(worker.wait())
+            except KeyboardInterrupt:
+                # the workers got the same interrupt, wait for them
+                codes.append(worker.wait())
+            if codes[-1]:
+                # the others would block forever in their collectives
+                forward(signal.SIGTERM, None)
+        return next((code for code in codes if code), 0)
+    finally:
+        signal.signal(signal.SIGTERM, previous)
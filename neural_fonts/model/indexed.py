@@ -0,0 +1,142 @@
+import os
+import pickle
+from collections.abc import Sequence
+
+import numpy as np
+
+# Offset index of a pickled dataset, stored beside it as <name>.obj.idx
+#   npy int64 [2]        : size and mtime of the indexed file
+#   npy INDEX_DTYPE rows : one per readable record, in file order
+#   npy str              : code table, the strings INDEX_DTYPE.code points to
+INDEX_SUFFIX = ".idx"
+INDEX_DTYPE = np.dtype(
+    [("offset", "<u8"), ("length", "<u4"), ("label", "<i4"), ("code", "<i4")]
+)
+
+
+def index_path(obj_path) -> str:
+    return os.fspath(obj_path) + INDEX_SUFFIX
+
+
+def file_signature(path) -> np.ndarray:
+    stat = os.stat(path)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def build_offset_index(obj_path):
+    """
+    Read a pickled dataset once, recording where each record starts,
+    how long it is and its label and code.
+    Returns the index rows and the code table
+    """
+    rows = []
+    code_table: dict[str, int] = {}
+    skipped = 0
+    with open(obj_path, "rb") as f:
+        while True:
+            offset = f.tell()
+            try:
+                e = pickle.load(f)
+            except EOFError:
+                break
+            except Exception as exc:
+                skipped += 1
+                print("unreadable record at offset %d: %r" % (offset, exc))
+                continue
+            # records of old packages have no code
+            code = e[1] if len(e) > 2 else ""
+            code_id = code_table.setdefault(str(code), len(code_table))
+            rows.append((offset, f.tell() - offset, int(e[0]), code_id))
+    if skipped:
+        print("skipped %d unreadable records of %s" % (skipped, obj_path))
+    index = np.array(rows, dtype=INDEX_DTYPE)
+    return index, sorted(code_table, key=code_table.__getitem__)
+
+
+def load_offset_index(obj_path):
+    """
+    Offset index of a pickled dataset, built and saved beside it when
+    missing or older than the dataset
+    """
+    path = index_path(obj_path)
+    signature = file_signature(obj_path)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            if np.array_equal(np.load(f), signature):
+                return np.load(f), np.load(f).tolist()
+    print("index %s" % obj_path)
+    index, code_table = build_offset_index(obj_path)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.save(f, signature)
+        np.save(f, index)
+        np.save(f, np.array(code_table, dtype=str))
+    os.replace(tmp_path, path)
+    return index, code_table
+
+
+class IndexedExamples(Sequence):
+    """
+    Random access (label, code, payload) view over the selected records,
+    each read and unpickled on demand
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def __len__(self):
+        return len(self.provider.index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.provider.read(self.provider.index[i])
+
+
+class IndexedImageProvider:
+    """
+    Read records of a pickled dataset lazily through its offset index,
+    so working on a few labels or characters does not load the whole file
+    """
+
+    def __init__(self, obj_path):
+        self.obj_path = obj_path
+        self.index, self.code_table = load_offset_index(obj_path)
+        self.fd = os.open(obj_path, os.O_RDONLY)
+        self.lookup: dict[tuple[int, str], int] | None = None
+        self.examples = IndexedExamples(self)
+        print("indexed total %d examples" % len(self.index))
+
+    def __del__(self):
+        if getattr(self, "fd", None) is not None:
+            os.close(self.fd)
+
+    @property
+    def labels(self):
+        return self.index["label"]
+
+    def read(self, row):
+        # pread does not move a shared file position, so prefetch
+        # threads can read concurrently
+        data = os.pread(self.fd, int(row["length"]), int(row["offset"]))
+        return pickle.loads(data)
+
+    def select(self, labels):
+        """
+        Keep only the examples of the given labels
+        """
+        self.index = self.index[np.isin(self.index["label"], list(labels))]
+        self.lookup = None
+
+    def get(self, label, code):
+        """
+        The example of label for the character code, KeyError if missing
+        """
+        if self.lookup is None:
+            codes = self.index["code"].tolist()
+            labels = self.index["label"].tolist()
+            self.lookup = {
+                (l, self.code_table[c]): i
+                for i, (l, c) in enumerate(zip(labels, codes))
+            }
+        return self.read(self.index[self.lookup[(int(label), str(code))]])
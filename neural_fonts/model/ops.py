@@ -116,3 +116,159 @@ def conditional_instance_norm(
 
         z = norm * batch_scale + batch_shift
         return z
+
+
+# TF2 counterparts of the ops above, holding their own variables.
+# weights maps each variable to its name under the layer scope, the name
+# the graph ops give it, so checkpoints of either can be read by the other
+
+
+class Layer(tf.Module):
+    def __init__(self, scope):
+        super().__init__(name=scope)
+        self.scope = scope
+        self.weights: dict[str, tf.Variable] = {}
+
+    def add_weight(self, name, initial_value, trainable=True):
+        # statistics are updated by every replica on its own and averaged
+        # when read, like Keras does for batch normalization
+        self.weights[name] = tf.Variable(
+            initial_value,
+            trainable=trainable,
+            name=name,
+            synchronization=tf.VariableSynchronization.AUTO
+            if trainable
+            else tf.VariableSynchronization.ON_READ,
+            aggregation=tf.VariableAggregation.NONE
+            if trainable
+            else tf.VariableAggregation.MEAN,
+        )
+        return self.weights[name]
+
+
+class Conv2d(Layer):
+    def __init__(
+        self,
+        input_filters,
+        output_filters,
+        kh=5,
+        kw=5,
+        sh=2,
+        sw=2,
+        stddev=0.02,
+        scope="conv2d",
+    ):
+        super().__init__(scope)
+        self.strides = [1, sh, sw, 1]
+        self.W = self.add_weight(
+            "W",
+            tf.random.truncated_normal(
+                [kh, kw, input_filters, output_filters], stddev=stddev
+            ),
+        )
+        self.b = self.add_weight("b", tf.zeros([output_filters]))
+
+    def __call__(self, x):
+        conv = tf.nn.conv2d(x, self.W, strides=self.strides, padding="SAME")
+        return tf.nn.bias_add(conv, self.b)
+
+
+class Deconv2d(Layer):
+    def __init__(
+        self,
+        input_filters,
+        output_filters,
+        kh=5,
+        kw=5,
+        sh=2,
+        sw=2,
+        stddev=0.02,
+        scope="deconv2d",
+    ):
+        super().__init__(scope)
+        self.strides = [1, sh, sw, 1]
+        self.output_filters = output_filters
+        # filter : [height, width, output_channels, in_channels]
+        self.W = self.add_weight(
+            "W",
+            tf.random.normal([kh, kw, output_filters, input_filters], stddev=stddev),
+        )
+        self.b = self.add_weight("b", tf.zeros([output_filters]))
+
+    def __call__(self, x, output_width):
+        output_shape = [tf.shape(x)[0], output_width, output_width, self.output_filters]
+        deconv = tf.nn.conv2d_transpose(
+            x, self.W, output_shape=output_shape, strides=self.strides
+        )
+        return tf.nn.bias_add(deconv, self.b)
+
+
+class BatchNorm(Layer):
+    def __init__(self, filters, epsilon=1e-5, decay=0.9, scope="batch_norm"):
+        super().__init__(scope)
+        self.epsilon = epsilon
+        self.decay = decay
+        self.beta = self.add_weight("beta", tf.zeros([filters]))
+        self.gamma = self.add_weight("gamma", tf.ones([filters]))
+        self.moving_mean = self.add_weight(
+            "moving_mean", tf.zeros([filters]), trainable=False
+        )
+        self.moving_variance = self.add_weight(
+            "moving_variance", tf.ones([filters]), trainable=False
+        )
+
+    def __call__(self, x, is_training):
+        if not is_training:
+            y, _, _ = tf.compat.v1.nn.fused_batch_norm(
+                x,
+                self.gamma,
+                self.beta,
+                mean=self.moving_mean,
+                variance=self.moving_variance,
+                epsilon=self.epsilon,
+                is_training=False,
+            )
+            return y
+        y, mean, variance = tf.compat.v1.nn.fused_batch_norm(
+            x, self.gamma, self.beta, epsilon=self.epsilon, is_training=True
+        )
+        # moving averages are updated in place, like updates_collections=None
+        self.moving_mean.assign_sub((1 - self.decay) * (self.moving_mean - mean))
+        self.moving_variance.assign_sub(
+            (1 - self.decay) * (self.moving_variance - variance)
+        )
+        return y
+
+
+class Fc(Layer):
+    def __init__(self, input_size, output_size, stddev=0.02, scope="fc"):
+        super().__init__(scope)
+        self.W = self.add_weight(
+            "W", tf.random.normal([input_size, output_size], stddev=stddev)
+        )
+        self.b = self.add_weight("b", tf.zeros([output_size]))
+
+    def __call__(self, x):
+        return tf.matmul(x, self.W) + self.b
+
+
+class Embedding(Layer):
+    def __init__(self, size, dimension, stddev=0.01, scope="embedding"):
+        super().__init__(scope)
+        self.E = self.add_weight(
+            "E", tf.random.normal([size, 1, 1, dimension], stddev=stddev)
+        )
+
+
+class ConditionalInstanceNorm(Layer):
+    def __init__(self, labels_num, filters, scope="conditional_instance_norm"):
+        super().__init__(scope)
+        self.scale = self.add_weight("scale", tf.ones([labels_num, filters]))
+        self.shift = self.add_weight("shift", tf.zeros([labels_num, filters]))
+
+    def __call__(self, x, ids):
+        mu, sigma = tf.nn.moments(x, [1, 2], keepdims=True)
+        norm = (x - mu) / tf.sqrt(sigma + 1e-5)
+        batch_scale = tf.gather(self.scale, ids)[:, None, None, :]
+        batch_shift = tf.gather(self.shift, ids)[:, None, None, :]
+        return norm * batch_scale + batch_shift
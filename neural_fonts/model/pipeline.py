@@ -0,0 +1,100 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from neural_fonts.model.dataset import make_batch
+
+
+def staging_variable(name, dtype, shape):
+    # local, so savers and checkpoints leave it out
+    return tf.Variable(
+        tf.zeros(shape, dtype=dtype),
+        trainable=False,
+        collections=[tf.GraphKeys.LOCAL_VARIABLES],
+        name=name,
+    )
+
+
+class BatchPipeline:
+    """
+    Feed training batches to the graph through tf.data instead of feed_dict.
+    Batches of examples are decoded and augmented by a parallel map on
+    TensorFlow's threadpool and prefetched, then copied into staging
+    variables once per step, so every sess.run of a step sees the same batch
+    """
+
+    def __init__(self, batch_size, width, filters, augment=True):
+        self.batch_size = batch_size
+        self.augment = augment
+        self.flip_labels = False
+        self.batches = iter(())
+        # batches handed to the map by id, python objects do not fit a tensor
+        self.pending = {}
+        self.image_shape = [batch_size, width, width, filters]
+
+        with tf.name_scope("input_pipeline"):
+            dataset = tf.data.Dataset.from_generator(
+                self._batch_ids, output_types=tf.int64, output_shapes=()
+            )
+            dataset = dataset.map(
+                self._load, num_parallel_calls=tf.data.experimental.AUTOTUNE
+            )
+            dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
+            self.iterator = tf.compat.v1.data.make_initializable_iterator(dataset)
+            labels, shuffled_labels, images = self.iterator.get_next()
+
+            self.images = staging_variable(
+                "staged_images", tf.float32, self.image_shape
+            )
+            self.labels = staging_variable("staged_labels", tf.int64, [batch_size])
+            self.shuffled_labels = staging_variable(
+                "staged_shuffled_labels", tf.int64, [batch_size]
+            )
+            self.next_batch = tf.group(
+                self.images.assign(images),
+                self.labels.assign(labels),
+                self.shuffled_labels.assign(shuffled_labels),
+            )
+
+    def _batch_ids(self):
+        for i, batch in enumerate(self.batches):
+            self.pending[i] = batch
+            yield i
+
+    def _make_batch(self, batch_id):
+        batch, rng = self.pending.pop(int(batch_id))
+        labels, _, images = make_batch(batch, self.augment, rng)
+        labels = np.asarray(labels, dtype=np.int64)
+        shuffled_labels = rng.permutation(labels) if self.flip_labels else labels
+        return labels, shuffled_labels, images
+
+    def _load(self, batch_id):
+        labels, shuffled_labels, images = tf.numpy_function(
+            self._make_batch, [batch_id], (tf.int64, tf.int64, tf.float32)
+        )
+        labels.set_shape([self.batch_size])
+        shuffled_labels.set_shape([self.batch_size])
+        images.set_shape(self.image_shape)
+        return labels, shuffled_labels, images
+
+    def epoch(self, sess, batches, rngs, flip_labels=False, wait=None):
+        """
+        Run through batches, staging each of them in turn, augmented and
+        label flipped with the generator of the same position in rngs.
+        Yields once a batch is staged, time spent waiting for it is added
+        to wait
+        """
+        self.batches = zip(batches, rngs)
+        self.flip_labels = flip_labels
+        self.pending.clear()
+        sess.run(self.iterator.initializer)
+        while True:
+            start = time.perf_counter()
+            try:
+                sess.run(self.next_batch)
+            except tf.errors.OutOfRangeError:
+                return
+            if wait is not None:
+                wait.add(time.perf_counter() - start)
+            yield
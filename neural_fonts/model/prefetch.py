@@ -0,0 +1,55 @@
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+_done = object()
+
+
+class WaitTimer:
+    """
+    Time the consumer of a pipeline spent blocked on it
+    """
+
+    def __init__(self):
+        self.seconds = 0.0
+        self.count = 0
+
+    def add(self, seconds):
+        self.seconds += seconds
+        self.count += 1
+
+
+def prefetch(items, fn, depth=0, workers=1, wait=None):
+    """
+    Yield fn(item) for every item, in order. With depth, up to depth results
+    are computed ahead by a pool of worker threads while the consumer is
+    busy; without, each is computed on demand. Time spent waiting for a
+    result is added to wait
+    """
+    items = iter(items)
+    if depth <= 0:
+        while True:
+            start = time.perf_counter()
+            item = next(items, _done)
+            if item is _done:
+                return
+            result = fn(item)
+            if wait is not None:
+                wait.add(time.perf_counter() - start)
+            yield result
+    executor = ThreadPoolExecutor(workers)
+    try:
+        pending = collections.deque(
+            executor.submit(fn, item) for _, item in zip(range(depth), items)
+        )
+        while pending:
+            start = time.perf_counter()
+            result = pending.popleft().result()
+            item = next(items, _done)
+            if item is not _done:
+                pending.append(executor.submit(fn, item))
+            if wait is not None:
+                wait.add(time.perf_counter() - start)
+            yield result
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
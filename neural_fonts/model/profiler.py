@@ -0,0 +1,135 @@
+import collections
+import contextlib
+import json
+import os
+import time
+
+import numpy as np
+
+PERCENTILES = [50, 90, 99]
+
+
+class StepProfiler:
+    """
+    Time the phases of every training step: the wait for its batch as
+    "data", the rest as timed by phase(), the whole as "step". Exports
+    percentiles of the last window steps and the throughput as JSON lines
+    and as a Prometheus textfile. trace_steps is the (first, last) step
+    to trace, if any
+    """
+
+    def __init__(
+        self,
+        examples_per_step,
+        window=200,
+        jsonl_path=None,
+        prometheus_path=None,
+        trace_steps=None,
+    ):
+        self.examples_per_step = examples_per_step
+        self.jsonl_path = jsonl_path
+        self.prometheus_path = prometheus_path
+        self.trace_steps = trace_steps
+        self.durations: dict[str, collections.deque] = collections.defaultdict(
+            lambda: collections.deque(maxlen=window)
+        )
+        self.current: dict[str, float] = {}
+        self.step_start = None
+        self.last_end = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.current[name] = self.current.get(name, 0.0) + elapsed
+
+    def begin_step(self):
+        now = time.perf_counter()
+        if self.last_end is None:
+            self.step_start = now
+        else:
+            self.current["data"] = now - self.last_end
+            self.step_start = self.last_end
+
+    def end_step(self):
+        now = time.perf_counter()
+        self.current["step"] = now - self.step_start
+        for name, seconds in self.current.items():
+            self.durations[name].append(seconds)
+        self.current = {}
+        self.last_end = now
+
+    def tracing(self, step) -> bool:
+        if self.trace_steps is None:
+            return False
+        first, last = self.trace_steps
+        return first <= step <= last
+
+    def examples_per_sec(self) -> float:
+        steps = self.durations["step"]
+        total = sum(steps)
+        return self.examples_per_step * len(steps) / total if total else 0.0
+
+    def summary(self):
+        """
+        phase -> count, mean and percentiles in seconds over the window
+        """
+        summary = {}
+        for name, durations in self.durations.items():
+            values = np.fromiter(durations, dtype=np.float64)
+            if not len(values):
+                continue
+            stats = {"count": len(values), "mean": float(values.mean())}
+            for p, value in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+                stats["p%d" % p] = float(value)
+            summary[name] = stats
+        return summary
+
+    def export(self, step):
+        summary = self.summary()
+        examples_per_sec = self.examples_per_sec()
+        if self.jsonl_path:
+            record = {
+                "step": step,
+                "time": time.time(),
+                "examples_per_sec": examples_per_sec,
+                "phases": summary,
+            }
+            with open(self.jsonl_path, "a") as f:
+                f.write(json.dumps(record) + "\n")
+        if self.prometheus_path:
+            self.write_prometheus(step, summary, examples_per_sec)
+
+    def write_prometheus(self, step, summary, examples_per_sec):
+        metric = "neural_fonts_step_phase_seconds"
+        lines = [
+            "# HELP %s Duration of training step phases over the last steps" % metric,
+            "# TYPE %s summary" % metric,
+        ]
+        for name, stats in sorted(summary.items()):
+            for p in PERCENTILES:
+                lines.append(
+                    '%s{phase="%s",quantile="%g"} %.9g'
+                    % (metric, name, p / 100, stats["p%d" % p])
+                )
+            lines.append(
+                '%s_sum{phase="%s"} %.9g'
+                % (metric, name, stats["mean"] * stats["count"])
+            )
+            lines.append('%s_count{phase="%s"} %d' % (metric, name, stats["count"]))
+        lines += [
+            "# HELP neural_fonts_examples_per_second Training throughput",
+            "# TYPE neural_fonts_examples_per_second gauge",
+            "neural_fonts_examples_per_second %.9g" % examples_per_sec,
+            "# HELP neural_fonts_step Last training step",
+            "# TYPE neural_fonts_step gauge",
+            "neural_fonts_step %d" % step,
+        ]
+        # textfile collectors may read at any time, replace it whole
+        tmp_path = self.prometheus_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.prometheus_path)
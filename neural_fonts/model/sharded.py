@@ -0,0 +1,163 @@
+import glob
+import os
+import pickle
+from collections.abc import Sequence
+
+import numpy as np
+
+# Sharded dataset layout
+#   <name>.obj          : index, magic followed by two npy arrays
+#                         - INDEX_DTYPE rows, one per example
+#                         - code table, the strings INDEX_DTYPE.code points to
+#   <name>-00000.shard  : pickled (label, code, payload) records, the same
+#                         records as a pickled dataset file
+MAGIC = b"NFSHRD01"
+INDEX_DTYPE = np.dtype(
+    [("shard", "<u4"), ("offset", "<u8"), ("label", "<i4"), ("code", "<i4")]
+)
+
+
+def is_sharded(path) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def shard_path(index_path, shard: int) -> str:
+    return "%s-%05d.shard" % (os.path.splitext(index_path)[0], shard)
+
+
+def shard_paths(index_path) -> list[str]:
+    stem = glob.escape(os.path.splitext(index_path)[0])
+    return sorted(glob.glob(stem + "-[0-9]*.shard"))
+
+
+class ShardedWriter:
+    """
+    Append examples to shards of shard_size examples each, and write
+    the index of all of them on close
+    """
+
+    def __init__(self, index_path, shard_size=10000):
+        self.index_path = index_path
+        self.shard_size = shard_size
+        self.rows: list[tuple[int, int, int, int]] = []
+        self.code_table: dict[str, int] = {}
+        for stale in shard_paths(index_path):
+            os.remove(stale)
+        self.shard = -1
+        self.file = None
+        self.closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, label, code, payload):
+        if self.file is None or len(self.rows) % self.shard_size == 0:
+            if self.file is not None:
+                self.file.close()
+            self.shard += 1
+            self.file = open(shard_path(self.index_path, self.shard), "wb")
+        code_id = self.code_table.setdefault(str(code), len(self.code_table))
+        self.rows.append((self.shard, self.file.tell(), int(label), code_id))
+        pickle.dump((label, code, payload), self.file)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.file is not None:
+            self.file.close()
+        index = np.array(self.rows, dtype=INDEX_DTYPE)
+        code_table = np.array(
+            sorted(self.code_table, key=self.code_table.__getitem__), dtype=str
+        )
+        with open(self.index_path, "wb") as f:
+            f.write(MAGIC)
+            np.save(f, index)
+            np.save(f, code_table)
+
+
+class ShardedExamples(Sequence):
+    """
+    Random access (label, code, payload) view over the selected examples,
+    each read from its shard on demand
+    """
+
+    def __init__(self, provider):
+        self.provider = provider
+
+    def __len__(self):
+        return len(self.provider.index)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        row = self.provider.index[i]
+        with open(self.provider.shard_path(row["shard"]), "rb") as f:
+            f.seek(row["offset"])
+            return pickle.load(f)
+
+
+class ShardedImageProvider:
+    """
+    Stream examples from a sharded dataset. Only the index is kept in
+    memory, examples are read shard by shard
+    """
+
+    def __init__(self, obj_path):
+        self.obj_path = obj_path
+        with open(obj_path, "rb") as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise ValueError("%s is not a sharded dataset" % obj_path)
+            self.index = np.load(f)
+            self.code_table = np.load(f).tolist()
+        self.examples = ShardedExamples(self)
+        print(
+            "indexed total %d examples in %d shards"
+            % (len(self.index), len(np.unique(self.index["shard"])))
+        )
+
+    @property
+    def labels(self):
+        return self.index["label"]
+
+    def shard_path(self, shard):
+        return shard_path(self.obj_path, int(shard))
+
+    def select(self, labels):
+        """
+        Keep only the examples of the given labels
+        """
+        self.index = self.index[np.isin(self.index["label"], list(labels))]
+
+    def stream(self, shuffle=True, buffer_size=2048, rng=np.random):
+        """
+        Yield every selected example once. With shuffle, shards are visited
+        in random order and examples leave through a shuffle buffer of
+        buffer_size, which bounds the memory use. The order only depends
+        on the state of rng
+        """
+        order = np.lexsort((self.index["offset"], self.index["shard"]))
+        index = self.index[order]
+        shards, starts = np.unique(index["shard"], return_index=True)
+        groups = np.split(index, starts[1:])
+        visit = rng.permutation(len(shards)) if shuffle else range(len(shards))
+        buffer = []
+        for i in visit:
+            with open(self.shard_path(shards[i]), "rb") as f:
+                for row in groups[i]:
+                    f.seek(row["offset"])
+                    example = pickle.load(f)
+                    if not shuffle:
+                        yield example
+                        continue
+                    buffer.append(example)
+                    if len(buffer) >= buffer_size:
+                        j = rng.randint(len(buffer))
+                        buffer[j], buffer[-1] = buffer[-1], buffer[j]
+                        yield buffer.pop()
+        rng.shuffle(buffer)
+        yield from buffer
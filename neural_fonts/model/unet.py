@@ -1,16 +1,27 @@
+import contextlib
+import json
 import os
+import signal
 import time
 from collections import namedtuple
 
 import numpy as np
-import scipy.misc as misc
 import tensorflow as tf
 from cv2 import bilateralFilter
 from PIL import Image, ImageEnhance
 from skimage.metrics import structural_similarity as ssim
+from tensorflow.python.client import timeline
 
+from neural_fonts.model.checkpoint import AsyncCheckpointer
 from neural_fonts.model.dataset import InjectDataProvider, TrainDataProvider
 from neural_fonts.model.ops import (
+    BatchNorm,
+    ConditionalInstanceNorm,
+    Conv2d,
+    Deconv2d,
+    Embedding,
+    Fc,
+    Layer,
     batch_norm,
     conditional_instance_norm,
     conv2d,
@@ -19,7 +30,39 @@ from neural_fonts.model.ops import (
     init_embedding,
     lrelu,
 )
-from neural_fonts.model.utils import merge, save_concat_images, scale_back
+from neural_fonts.model.pipeline import BatchPipeline
+from neural_fonts.model.profiler import StepProfiler
+from neural_fonts.model.utils import merge, save_concat_images, save_image, scale_back
+
+# training position saved beside the checkpoints, to resume from the same batch
+TRAIN_STATE = "train_state.json"
+
+
+@contextlib.contextmanager
+def stop_requests():
+    """
+    Record SIGTERM and SIGINT in the yielded list instead of dying of them,
+    so training can stop after the current step with a checkpoint to resume
+    from the next batch. A second SIGINT interrupts at once
+    """
+    stop_signals = []
+
+    def request_stop(signum, frame):
+        if stop_signals and signum == signal.SIGINT:
+            raise KeyboardInterrupt
+        print("received signal %d, stop after this step" % signum)
+        stop_signals.append(signum)
+
+    handlers = {
+        signum: signal.signal(signum, request_stop)
+        for signum in (signal.SIGTERM, signal.SIGINT)
+    }
+    try:
+        yield stop_signals
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+
 
 # Auxiliary wrapper classes
 # Used to save handles(important nodes in computation graph) for later evaluation
@@ -88,14 +131,15 @@ class UNet:
             self.log_dir = os.path.join(self.experiment_dir, "logs")
             self.progress_file = os.path.join(self.log_dir, "progress")
 
+            # workers of a cluster may race to create them
             if not os.path.exists(self.checkpoint_dir):
-                os.makedirs(self.checkpoint_dir)
+                os.makedirs(self.checkpoint_dir, exist_ok=True)
                 print("create checkpoint directory")
             if not os.path.exists(self.log_dir):
-                os.makedirs(self.log_dir)
+                os.makedirs(self.log_dir, exist_ok=True)
                 print("create log directory")
             if not os.path.exists(self.sample_dir):
-                os.makedirs(self.sample_dir)
+                os.makedirs(self.sample_dir, exist_ok=True)
                 print("create sample directory")
 
     def encoder(self, images, is_training, reuse=False):
@@ -282,189 +326,70 @@ class UNet:
 
             return tf.nn.sigmoid(fc1), fc1, fc2
 
-    def build_model(self, is_training=True, inst_norm=False, no_target_source=False):
-        real_data = tf.placeholder(
-            tf.float32,
-            [
-                self.batch_size,
-                self.input_width,
-                self.input_width,
-                self.input_filters + self.output_filters,
-            ],
-            name="real_A_and_B_images",
-        )
-        embedding_ids = tf.placeholder(tf.int64, shape=None, name="embedding_ids")
-        no_target_data = tf.placeholder(
-            tf.float32,
-            [
+    def build_model(
+        self,
+        is_training=True,
+        inst_norm=False,
+        no_target_source=False,
+        input_pipeline=False,
+    ):
+        image_shape = [
+            self.batch_size,
+            self.input_width,
+            self.input_width,
+            self.input_filters + self.output_filters,
+        ]
+        self.pipeline = None
+        if input_pipeline:
+            # training batches come from the staged tf.data batch,
+            # a feed still overrides them for validation and inference
+            self.pipeline = BatchPipeline(
                 self.batch_size,
                 self.input_width,
-                self.input_width,
                 self.input_filters + self.output_filters,
-            ],
-            name="no_target_A_and_B_images",
-        )
-        no_target_ids = tf.placeholder(
-            tf.int64, shape=None, name="no_target_embedding_ids"
-        )
-
-        # target images
-        real_B = real_data[:, :, :, : self.input_filters]
-        # source images
-        real_A = real_data[
-            :, :, :, self.input_filters : self.input_filters + self.output_filters
-        ]
-
-        embedding = init_embedding(self.embedding_num, self.embedding_dim)
-        fake_B, encoded_real_A = self.generator(
-            real_A,
-            embedding,
-            embedding_ids,
-            is_training=is_training,
-            inst_norm=inst_norm,
-        )
-        real_AB = tf.concat([real_A, real_B], 3)
-        fake_AB = tf.concat([real_A, fake_B], 3)
-
-        # Note it is not possible to set reuse flag back to False
-        # initialize all variables before setting reuse to True
-        real_D, real_D_logits, real_category_logits = self.discriminator(
-            real_AB, is_training=is_training, reuse=False
-        )
-        fake_D, fake_D_logits, fake_category_logits = self.discriminator(
-            fake_AB, is_training=is_training, reuse=True
-        )
-
-        # encoding constant loss
-        # this loss assume that generated imaged and real image
-        # should reside in the same space and close to each other
-        encoded_fake_B = self.encoder(fake_B, is_training, reuse=True)[0]
-        const_loss = (
-            tf.reduce_mean(tf.square(encoded_real_A - encoded_fake_B))
-        ) * self.Lconst_penalty
-
-        # category loss
-        true_labels = tf.reshape(
-            tf.one_hot(indices=embedding_ids, depth=self.embedding_num),
-            shape=[self.batch_size, self.embedding_num],
-        )
-        real_category_loss = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=real_category_logits, labels=true_labels
             )
-        )
-        fake_category_loss = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=fake_category_logits, labels=true_labels
-            )
-        )
-        category_loss = self.Lcategory_penalty * (
-            real_category_loss + fake_category_loss
-        )
-
-        # binary real/fake loss
-        d_loss_real = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=real_D_logits, labels=tf.ones_like(real_D)
+            real_data = tf.placeholder_with_default(
+                self.pipeline.images, image_shape, name="real_A_and_B_images"
             )
-        )
-        d_loss_fake = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=fake_D_logits, labels=tf.zeros_like(fake_D)
+            embedding_ids = tf.placeholder_with_default(
+                self.pipeline.labels, [self.batch_size], name="embedding_ids"
             )
-        )
-        # L1 loss between real and generated images
-        l1_loss = self.L1_penalty * tf.reduce_mean(tf.abs(fake_B - real_B))
-        # total variation loss
-        width = self.output_width
-        tv_loss = (
-            tf.nn.l2_loss(fake_B[:, 1:, :, :] - fake_B[:, : width - 1, :, :]) / width
-            + tf.nn.l2_loss(fake_B[:, :, 1:, :] - fake_B[:, :, : width - 1, :]) / width
-        ) * self.Ltv_penalty
-
-        # maximize the chance generator fool the discriminator
-        cheat_loss = tf.reduce_mean(
-            tf.nn.sigmoid_cross_entropy_with_logits(
-                logits=fake_D_logits, labels=tf.ones_like(fake_D)
+            no_target_data = tf.placeholder_with_default(
+                self.pipeline.images, image_shape, name="no_target_A_and_B_images"
             )
-        )
-
-        d_loss = d_loss_real + d_loss_fake + category_loss / 2.0
-        g_loss = (
-            cheat_loss
-            + l1_loss
-            + self.Lcategory_penalty * fake_category_loss
-            + const_loss
-            + tv_loss
-        )
-
-        if no_target_source:
-            # no_target source are examples that don't have the corresponding target images
-            # however, except L1 loss, we can compute category loss, binary loss and constant losses with those examples
-            # it is useful when discriminator get saturated and d_loss drops to near zero
-            # those data could be used as additional source of losses to break the saturation
-            no_target_A = no_target_data[
-                :, :, :, self.input_filters : self.input_filters + self.output_filters
-            ]
-            no_target_B, encoded_no_target_A = self.generator(
-                no_target_A,
-                embedding,
-                no_target_ids,
-                is_training=is_training,
-                inst_norm=inst_norm,
-                reuse=True,
+            no_target_ids = tf.placeholder_with_default(
+                self.pipeline.shuffled_labels,
+                [self.batch_size],
+                name="no_target_embedding_ids",
             )
-            no_target_labels = tf.reshape(
-                tf.one_hot(indices=no_target_ids, depth=self.embedding_num),
-                shape=[self.batch_size, self.embedding_num],
+        else:
+            real_data = tf.placeholder(
+                tf.float32, image_shape, name="real_A_and_B_images"
             )
-            no_target_AB = tf.concat([no_target_A, no_target_B], 3)
-            (
-                no_target_D,
-                no_target_D_logits,
-                no_target_category_logits,
-            ) = self.discriminator(no_target_AB, is_training=is_training, reuse=True)
-            encoded_no_target_B = self.encoder(no_target_B, is_training, reuse=True)[0]
-            no_target_const_loss = (
-                tf.reduce_mean(tf.square(encoded_no_target_A - encoded_no_target_B))
-                * self.Lconst_penalty
+            embedding_ids = tf.placeholder(tf.int64, shape=None, name="embedding_ids")
+            no_target_data = tf.placeholder(
+                tf.float32, image_shape, name="no_target_A_and_B_images"
             )
-            no_target_category_loss = (
-                tf.reduce_mean(
-                    tf.nn.sigmoid_cross_entropy_with_logits(
-                        logits=no_target_category_logits, labels=no_target_labels
-                    )
-                )
-                * self.Lcategory_penalty
+            no_target_ids = tf.placeholder(
+                tf.int64, shape=None, name="no_target_embedding_ids"
             )
 
-            d_loss_no_target = tf.reduce_mean(
-                tf.nn.sigmoid_cross_entropy_with_logits(
-                    logits=no_target_D_logits, labels=tf.zeros_like(no_target_D)
-                )
-            )
-            cheat_loss += tf.reduce_mean(
-                tf.nn.sigmoid_cross_entropy_with_logits(
-                    logits=no_target_D_logits, labels=tf.ones_like(no_target_D)
-                )
-            )
-            d_loss = (
-                d_loss_real
-                + d_loss_fake
-                + d_loss_no_target
-                + (category_loss + no_target_category_loss) / 3.0
-            )
-            g_loss = (
-                cheat_loss / 2.0
-                + l1_loss
-                + (
-                    self.Lcategory_penalty * fake_category_loss
-                    + no_target_category_loss
-                )
-                / 2.0
-                + (const_loss + no_target_const_loss) / 2.0
-                + tv_loss
-            )
+        # rebuilt by a fused training step
+        self.loss_inputs = (real_data, embedding_ids, no_target_data, no_target_ids)
+        self.loss_args = dict(
+            inst_norm=inst_norm,
+            is_training=is_training,
+            no_target_source=no_target_source,
+        )
+        terms = self.build_losses(*self.loss_inputs, **self.loss_args)
+        real_A, real_B, fake_B = terms["real_A"], terms["real_B"], terms["fake_B"]
+        encoded_real_A, embedding = terms["encoded_real_A"], terms["embedding"]
+        d_loss_real, d_loss_fake = terms["d_loss_real"], terms["d_loss_fake"]
+        category_loss = terms["category_loss"]
+        fake_category_loss = terms["fake_category_loss"]
+        cheat_loss, const_loss = terms["cheat_loss"], terms["const_loss"]
+        l1_loss, tv_loss = terms["l1_loss"], terms["tv_loss"]
+        d_loss, g_loss = terms["d_loss"], terms["g_loss"]
 
         d_loss_real_summary = tf.summary.scalar("d_loss_real", d_loss_real)
         d_loss_fake_summary = tf.summary.scalar("d_loss_fake", d_loss_fake)
@@ -535,6 +460,212 @@ class UNet:
         setattr(self, "eval_handle", eval_handle)
         setattr(self, "summary_handle", summary_handle)
 
+    def build_losses(
+        self,
+        real_data,
+        embedding_ids,
+        no_target_data,
+        no_target_ids,
+        inst_norm=False,
+        is_training=True,
+        no_target_source=False,
+        reuse=False,
+    ):
+        """
+        Losses of a batch and the tensors they are computed from, by name.
+        With reuse, they are built again over the variables of build_model
+        """
+        # training variables are resource variables, read where the graph
+        # uses them: losses built again under a control dependency on an
+        # update see the updated values. Inference keeps reference
+        # variables, interpolate overwrites them with other shapes
+        with tf.variable_scope(
+            tf.get_variable_scope(), reuse=reuse or None, use_resource=is_training
+        ):
+            # target images
+            real_B = real_data[:, :, :, : self.input_filters]
+            # source images
+            real_A = real_data[
+                :, :, :, self.input_filters : self.input_filters + self.output_filters
+            ]
+
+            embedding = init_embedding(self.embedding_num, self.embedding_dim)
+            fake_B, encoded_real_A = self.generator(
+                real_A,
+                embedding,
+                embedding_ids,
+                is_training=is_training,
+                inst_norm=inst_norm,
+                reuse=reuse,
+            )
+            real_AB = tf.concat([real_A, real_B], 3)
+            fake_AB = tf.concat([real_A, fake_B], 3)
+
+            real_D, real_D_logits, real_category_logits = self.discriminator(
+                real_AB, is_training=is_training, reuse=reuse
+            )
+            fake_D, fake_D_logits, fake_category_logits = self.discriminator(
+                fake_AB, is_training=is_training, reuse=True
+            )
+
+            # encoding constant loss
+            # this loss assume that generated imaged and real image
+            # should reside in the same space and close to each other
+            encoded_fake_B = self.encoder(fake_B, is_training, reuse=True)[0]
+            const_loss = (
+                tf.reduce_mean(tf.square(encoded_real_A - encoded_fake_B))
+            ) * self.Lconst_penalty
+
+            # category loss
+            true_labels = tf.reshape(
+                tf.one_hot(indices=embedding_ids, depth=self.embedding_num),
+                shape=[self.batch_size, self.embedding_num],
+            )
+            real_category_loss = tf.reduce_mean(
+                tf.nn.sigmoid_cross_entropy_with_logits(
+                    logits=real_category_logits, labels=true_labels
+                )
+            )
+            fake_category_loss = tf.reduce_mean(
+                tf.nn.sigmoid_cross_entropy_with_logits(
+                    logits=fake_category_logits, labels=true_labels
+                )
+            )
+            category_loss = self.Lcategory_penalty * (
+                real_category_loss + fake_category_loss
+            )
+
+            # binary real/fake loss
+            d_loss_real = tf.reduce_mean(
+                tf.nn.sigmoid_cross_entropy_with_logits(
+                    logits=real_D_logits, labels=tf.ones_like(real_D)
+                )
+            )
+            d_loss_fake = tf.reduce_mean(
+                tf.nn.sigmoid_cross_entropy_with_logits(
+                    logits=fake_D_logits, labels=tf.zeros_like(fake_D)
+                )
+            )
+            # L1 loss between real and generated images
+            l1_loss = self.L1_penalty * tf.reduce_mean(tf.abs(fake_B - real_B))
+            # total variation loss
+            width = self.output_width
+            tv_loss = (
+                tf.nn.l2_loss(fake_B[:, 1:, :, :] - fake_B[:, : width - 1, :, :])
+                / width
+                + tf.nn.l2_loss(fake_B[:, :, 1:, :] - fake_B[:, :, : width - 1, :])
+                / width
+            ) * self.Ltv_penalty
+
+            # maximize the chance generator fool the discriminator
+            cheat_loss = tf.reduce_mean(
+                tf.nn.sigmoid_cross_entropy_with_logits(
+                    logits=fake_D_logits, labels=tf.ones_like(fake_D)
+                )
+            )
+
+            d_loss = d_loss_real + d_loss_fake + category_loss / 2.0
+            g_loss = (
+                cheat_loss
+                + l1_loss
+                + self.Lcategory_penalty * fake_category_loss
+                + const_loss
+                + tv_loss
+            )
+
+            if no_target_source:
+                # no_target source are examples that don't have the corresponding target images
+                # however, except L1 loss, we can compute category loss, binary loss and constant losses with those examples
+                # it is useful when discriminator get saturated and d_loss drops to near zero
+                # those data could be used as additional source of losses to break the saturation
+                no_target_A = no_target_data[
+                    :,
+                    :,
+                    :,
+                    self.input_filters : self.input_filters + self.output_filters,
+                ]
+                no_target_B, encoded_no_target_A = self.generator(
+                    no_target_A,
+                    embedding,
+                    no_target_ids,
+                    is_training=is_training,
+                    inst_norm=inst_norm,
+                    reuse=True,
+                )
+                no_target_labels = tf.reshape(
+                    tf.one_hot(indices=no_target_ids, depth=self.embedding_num),
+                    shape=[self.batch_size, self.embedding_num],
+                )
+                no_target_AB = tf.concat([no_target_A, no_target_B], 3)
+                (
+                    no_target_D,
+                    no_target_D_logits,
+                    no_target_category_logits,
+                ) = self.discriminator(
+                    no_target_AB, is_training=is_training, reuse=True
+                )
+                encoded_no_target_B = self.encoder(
+                    no_target_B, is_training, reuse=True
+                )[0]
+                no_target_const_loss = (
+                    tf.reduce_mean(tf.square(encoded_no_target_A - encoded_no_target_B))
+                    * self.Lconst_penalty
+                )
+                no_target_category_loss = (
+                    tf.reduce_mean(
+                        tf.nn.sigmoid_cross_entropy_with_logits(
+                            logits=no_target_category_logits, labels=no_target_labels
+                        )
+                    )
+                    * self.Lcategory_penalty
+                )
+
+                d_loss_no_target = tf.reduce_mean(
+                    tf.nn.sigmoid_cross_entropy_with_logits(
+                        logits=no_target_D_logits, labels=tf.zeros_like(no_target_D)
+                    )
+                )
+                cheat_loss += tf.reduce_mean(
+                    tf.nn.sigmoid_cross_entropy_with_logits(
+                        logits=no_target_D_logits, labels=tf.ones_like(no_target_D)
+                    )
+                )
+                d_loss = (
+                    d_loss_real
+                    + d_loss_fake
+                    + d_loss_no_target
+                    + (category_loss + no_target_category_loss) / 3.0
+                )
+                g_loss = (
+                    cheat_loss / 2.0
+                    + l1_loss
+                    + (
+                        self.Lcategory_penalty * fake_category_loss
+                        + no_target_category_loss
+                    )
+                    / 2.0
+                    + (const_loss + no_target_const_loss) / 2.0
+                    + tv_loss
+                )
+
+        return {
+            "real_A": real_A,
+            "real_B": real_B,
+            "fake_B": fake_B,
+            "encoded_real_A": encoded_real_A,
+            "embedding": embedding,
+            "d_loss_real": d_loss_real,
+            "d_loss_fake": d_loss_fake,
+            "category_loss": category_loss,
+            "fake_category_loss": fake_category_loss,
+            "cheat_loss": cheat_loss,
+            "const_loss": const_loss,
+            "l1_loss": l1_loss,
+            "tv_loss": tv_loss,
+            "d_loss": d_loss,
+            "g_loss": g_loss,
+        }
+
     def register_session(self, sess):
         self.sess = sess
 
@@ -571,24 +702,90 @@ class UNet:
         model_dir = os.path.join(self.checkpoint_dir, model_id)
         return model_id, model_dir
 
-    def checkpoint(self, saver, step):
+    def checkpoint(self, saver, step, state=None):
         model_name = "unet.model"
         model_id, model_dir = self.get_model_id_and_dir()
 
         if not os.path.exists(model_dir):
             os.makedirs(model_dir)
 
-        saver.save(self.sess, os.path.join(model_dir, model_name), global_step=step)
+        # the state as of this step, the loop goes on while a save is written
+        state = None if state is None else dict(state)
 
-    def restore_model(self, saver, model_dir):
+        def on_saved(path):
+            if state is not None:
+                state["checkpoint"] = os.path.basename(path)
+                self.save_train_state(model_dir, state)
 
+        save_path = os.path.join(model_dir, model_name)
+        if isinstance(saver, AsyncCheckpointer):
+            saver.save(self.sess, save_path, global_step=step, on_saved=on_saved)
+        else:
+            on_saved(saver.save(self.sess, save_path, global_step=step))
+
+    def save_train_state(self, model_dir, state):
+        path = os.path.join(model_dir, TRAIN_STATE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+
+    def load_train_state(self, model_dir, checkpoint_path):
+        """
+        Training position saved with the checkpoint, None when there is
+        none or it belongs to another checkpoint
+        """
+        path = os.path.join(model_dir, TRAIN_STATE)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            state = json.load(f)
+        if state.get("checkpoint") != os.path.basename(checkpoint_path):
+            print("train state does not match %s, ignored" % checkpoint_path)
+            return None
+        return state
+
+    def step_profiler(self, trace_steps=None):
+        return StepProfiler(
+            self.batch_size,
+            jsonl_path=os.path.join(self.log_dir, "metrics.jsonl"),
+            prometheus_path=os.path.join(self.log_dir, "metrics.prom"),
+            trace_steps=trace_steps,
+        )
+
+    def save_trace(self, summary_writer, run_metadata, step, phase):
+        """
+        Keep a traced run for TensorBoard and as a chrome://tracing file
+        """
+        tag = "step_%d_%s" % (step, phase)
+        summary_writer.add_run_metadata(run_metadata, tag, step)
+        trace = timeline.Timeline(run_metadata.step_stats)
+        with open(os.path.join(self.log_dir, "trace_%s.json" % tag), "w") as f:
+            f.write(trace.generate_chrome_trace_format())
+
+    def restore_model(self, saver, model_dir):
+        """
+        Returns the path of the restored checkpoint, None without one
+        """
         ckpt = tf.train.get_checkpoint_state(model_dir)
 
         if ckpt:
             saver.restore(self.sess, ckpt.model_checkpoint_path)
             print("restored model %s" % model_dir)
+            return ckpt.model_checkpoint_path
         else:
             print("fail to restore model %s" % model_dir)
+            return None
+
+    def restore_generator(self, model_dir):
+        tf.global_variables_initializer().run()
+        saver = tf.train.Saver(var_list=self.retrieve_generator_vars())
+        self.restore_model(saver, model_dir)
+
+    def generate_fake_images(self, input_images, embedding_ids):
+        """
+        Generated images of a batch, for inference
+        """
+        return self.generate_fake_samples(input_images, embedding_ids)[0]
 
     def generate_fake_samples(self, input_images, embedding_ids):
         input_handle, loss_handle, eval_handle, summary_handle = self.retrieve_handles()
@@ -632,7 +829,7 @@ class UNet:
         sample_img_path = os.path.join(
             model_sample_dir, "sample_%02d_%04d.png" % (epoch, step)
         )
-        misc.imsave(sample_img_path, merged_pair)
+        save_image(sample_img_path, merged_pair)
 
     def export_generator(self, save_dir, model_dir, model_name="gen_model"):
         saver = tf.train.Saver()
@@ -659,9 +856,7 @@ class UNet:
                 self.batch_size, embedding_ids
             )
 
-        tf.global_variables_initializer().run()
-        saver = tf.train.Saver(var_list=self.retrieve_generator_vars())
-        self.restore_model(saver, model_dir)
+        self.restore_generator(model_dir)
 
         def save_imgs(imgs, count):
             p = os.path.join(save_dir, "inferred_%04d.png" % count)
@@ -678,7 +873,7 @@ class UNet:
         count = 0
         batch_buffer = list()
         for labels, codes, source_imgs in source_iter:
-            fake_imgs = self.generate_fake_samples(source_imgs, labels)[0]
+            fake_imgs = self.generate_fake_images(source_imgs, labels)
             for i in range(len(fake_imgs)):
                 # Denormalize image
                 gray_img = np.uint8(fake_imgs[i][:, :, 0] * 127.5 + 127.5)
@@ -721,9 +916,7 @@ class UNet:
                 self.batch_size, embedding_ids
             )
 
-        tf.global_variables_initializer().run()
-        saver = tf.train.Saver(var_list=self.retrieve_generator_vars())
-        self.restore_model(saver, model_dir)
+        self.restore_generator(model_dir)
 
         def save_imgs(imgs, count):
             p = os.path.join(save_dir, "inferred_%04d.png" % count)
@@ -787,9 +980,7 @@ class UNet:
         print("Average SSIM: %.5f" % (ssim_sum / sample_num))
 
     def interpolate(self, source_obj, between, model_dir, save_dir, steps):
-        tf.global_variables_initializer().run()
-        saver = tf.train.Saver(var_list=self.retrieve_generator_vars())
-        self.restore_model(saver, model_dir)
+        self.restore_generator(model_dir)
         # new interpolated dimension
         new_x_dim = steps + 1
         alphas = np.linspace(0.0, 1.0, new_x_dim)
@@ -890,6 +1081,18 @@ class UNet:
         sample_steps=50,
         checkpoint_steps=500,
         no_val=False,
+        decode_budget=0,
+        prefetch_depth=0,
+        prefetch_workers=1,
+        balance_labels=None,
+        fixed_val_batches=0,
+        fused_step=False,
+        summary_steps=1,
+        seed=None,
+        checkpoint_secs=0,
+        async_checkpoint=True,
+        profile_steps=0,
+        trace_steps=None,
     ):
         g_vars, d_vars = self.retrieve_trainable_vars(freeze_encoder=freeze_encoder)
         input_handle, loss_handle, _, summary_handle = self.retrieve_handles()
@@ -901,142 +1104,939 @@ class UNet:
             f.write("Start")
 
         learning_rate = tf.placeholder(tf.float32, name="learning_rate")
-        d_optimizer = tf.train.AdamOptimizer(learning_rate, beta1=0.5).minimize(
-            loss_handle.d_loss, var_list=d_vars
-        )
-        g_optimizer = tf.train.AdamOptimizer(learning_rate, beta1=0.5).minimize(
-            loss_handle.g_loss, var_list=g_vars
-        )
+        d_adam = tf.train.AdamOptimizer(learning_rate, beta1=0.5)
+        g_adam = tf.train.AdamOptimizer(learning_rate, beta1=0.5)
+        if fused_step:
+            # the serial step in a single run: D is updated, then G twice,
+            # each time against its losses built again under a dependency
+            # on the previous update, so they read the updated variables
+            train_step = d_adam.minimize(loss_handle.d_loss, var_list=d_vars)
+            for _ in range(2):
+                with tf.control_dependencies([train_step]):
+                    g_terms = self.build_losses(
+                        *self.loss_inputs, **self.loss_args, reuse=True
+                    )
+                    train_step = g_adam.minimize(g_terms["g_loss"], var_list=g_vars)
+        else:
+            d_optimizer = d_adam.minimize(loss_handle.d_loss, var_list=d_vars)
+            g_optimizer = g_adam.minimize(loss_handle.g_loss, var_list=g_vars)
+        # losses and summaries, only evaluated on steps that log them
+        d_stats = [loss_handle.d_loss, summary_handle.d_merged]
+        g_stats = [
+            loss_handle.g_loss,
+            loss_handle.category_loss,
+            loss_handle.cheat_loss,
+            loss_handle.const_loss,
+            loss_handle.l1_loss,
+            loss_handle.tv_loss,
+            summary_handle.g_merged,
+        ]
+        if fused_step:
+            # like the serial step, log the losses of the second G update.
+            # Summary ops are named once per graph, so they are summarised
+            # from the fetched values under the tags of build_model
+            g_summary_tags = [
+                "g_loss",
+                "fake_category_loss",
+                "cheat_loss",
+                "const_loss",
+                "l1_loss",
+                "tv_loss",
+            ]
+            g_stats = [
+                g_terms[name]
+                for name in [
+                    "g_loss",
+                    "category_loss",
+                    "cheat_loss",
+                    "const_loss",
+                    "l1_loss",
+                    "tv_loss",
+                ]
+            ]
+            g_stats.append([g_terms[tag] for tag in g_summary_tags])
         tf.global_variables_initializer().run()
+        tf.local_variables_initializer().run()
         real_data = input_handle.real_data
         embedding_ids = input_handle.embedding_ids
         no_target_data = input_handle.no_target_data
         no_target_ids = input_handle.no_target_ids
 
+        saver = tf.train.Saver(max_to_keep=3)
+        summary_writer = tf.summary.FileWriter(self.log_dir, self.sess.graph)
+
+        state = None
+        if resume:
+            _, model_dir = self.get_model_id_and_dir()
+            checkpoint_path = self.restore_model(saver, model_dir)
+            if checkpoint_path:
+                state = self.load_train_state(model_dir, checkpoint_path)
+        if state is None:
+            state = {"epoch": 0, "batch": 0, "step": 0, "lr": lr, "seed": seed}
+        else:
+            print(
+                "resume from epoch %d, batch %d, step %d"
+                % (state["epoch"], state["batch"], state["step"])
+            )
+        if async_checkpoint:
+            saver = AsyncCheckpointer(
+                {var.op.name: var for var in tf.global_variables()}, max_to_keep=3
+            )
+
         # filter by one type of labels
         data_provider = TrainDataProvider(
-            self.data_dir, filter_by=fine_tune, no_val=no_val
+            self.data_dir,
+            filter_by=fine_tune,
+            no_val=no_val,
+            decode_budget=decode_budget,
+            prefetch_depth=prefetch_depth,
+            prefetch_workers=prefetch_workers,
+            balance=balance_labels,
+            seed=state["seed"],
         )
+        state["seed"] = int(data_provider.seed)
         total_batches = data_provider.compute_total_batch_num(self.batch_size)
         val_batch_iter = 0
-        if not no_val:
+        if not no_val and fixed_val_batches:
+            val_batch_iter = data_provider.get_fixed_val_iter(
+                self.batch_size, fixed_val_batches
+            )
+        elif not no_val:
             val_batch_iter = data_provider.get_val_iter(self.batch_size)
 
-        saver = tf.train.Saver(max_to_keep=3)
-        summary_writer = tf.summary.FileWriter(self.log_dir, self.sess.graph)
-
-        if resume:
-            _, model_dir = self.get_model_id_and_dir()
-            self.restore_model(saver, model_dir)
-
-        current_lr = lr
-        counter = 0
+        current_lr = state["lr"]
+        counter = state["step"]
+        start_epoch, start_batch = state["epoch"], state["batch"]
         start_time = time.time()
-
-        for ei in range(epoch):
-            train_batch_iter = data_provider.get_train_iter(self.batch_size)
-
-            if (ei + 1) % schedule == 0:
-                update_lr = current_lr / 2.0
-                # minimum learning rate guarantee
-                update_lr = max(update_lr, 0.0002)
-                print("decay learning rate from %.5f to %.5f" % (current_lr, update_lr))
-                current_lr = update_lr
-
-            for bid, batch in enumerate(train_batch_iter):
-                counter += 1
-                labels, codes, batch_images = batch
-                shuffled_ids = labels[:]
-                if flip_labels:
-                    np.random.shuffle(shuffled_ids)
-                # Optimize D
-                _, batch_d_loss, d_summary = self.sess.run(
-                    [d_optimizer, loss_handle.d_loss, summary_handle.d_merged],
-                    feed_dict={
-                        real_data: batch_images,
-                        embedding_ids: labels,
-                        learning_rate: current_lr,
-                        no_target_data: batch_images,
-                        no_target_ids: shuffled_ids,
-                    },
-                )
-                # Optimize G
-                _, batch_g_loss = self.sess.run(
-                    [g_optimizer, loss_handle.g_loss],
-                    feed_dict={
-                        real_data: batch_images,
-                        embedding_ids: labels,
-                        learning_rate: current_lr,
-                        no_target_data: batch_images,
-                        no_target_ids: shuffled_ids,
-                    },
-                )
-                # magic move to Optimize G again
-                # according to https://github.com/carpedm20/DCGAN-tensorflow
-                # collect all the losses along the way
-                (
-                    _,
-                    batch_g_loss,
-                    category_loss,
-                    cheat_loss,
-                    const_loss,
-                    l1_loss,
-                    tv_loss,
-                    g_summary,
-                ) = self.sess.run(
-                    [
-                        g_optimizer,
-                        loss_handle.g_loss,
-                        loss_handle.category_loss,
-                        loss_handle.cheat_loss,
-                        loss_handle.const_loss,
-                        loss_handle.l1_loss,
-                        loss_handle.tv_loss,
-                        summary_handle.g_merged,
-                    ],
-                    feed_dict={
-                        real_data: batch_images,
-                        embedding_ids: labels,
-                        learning_rate: current_lr,
-                        no_target_data: batch_images,
-                        no_target_ids: shuffled_ids,
-                    },
+        last_checkpoint = start_time
+        profiler = self.step_profiler(trace_steps)
+
+        def run_step(phase, fetches, feed_dict, step):
+            # a session run timed as phase, and traced within trace_steps
+            with profiler.phase(phase):
+                if not profiler.tracing(step):
+                    return self.sess.run(fetches, feed_dict=feed_dict)
+                run_metadata = tf.RunMetadata()
+                result = self.sess.run(
+                    fetches,
+                    feed_dict=feed_dict,
+                    options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                    run_metadata=run_metadata,
                 )
-                passed = time.time() - start_time
-                log_format = (
-                    "Epoch: [%2d], [%4d/%4d] time: %4.4f, d_loss: %.5f, g_loss: %.5f, "
-                    + "category_loss: %.5f, cheat_loss: %.5f, const_loss: %.5f, l1_loss: %.5f, tv_loss: %.5f"
-                )
-                #                print(log_format % (ei, bid, total_batches, passed, batch_d_loss, batch_g_loss,
-                #                                    category_loss, cheat_loss, const_loss, l1_loss, tv_loss))
-                summary_writer.add_summary(d_summary, counter)
-                summary_writer.add_summary(g_summary, counter)
-
-                if (not no_val) and counter % sample_steps == 0:
-                    # sample the current model states with val data
-                    self.validate_model(val_batch_iter, ei, counter)
+            self.save_trace(summary_writer, run_metadata, step, phase)
+            return result
+
+        with stop_requests() as stop_signals:
+            for ei in range(start_epoch, epoch):
+                # the rest of an interrupted epoch, then whole ones
+                first = start_batch if ei == start_epoch else 0
+                if self.pipeline is not None:
+                    train_batch_iter = self.pipeline.epoch(
+                        self.sess,
+                        data_provider.train_batches(
+                            self.batch_size, epoch=ei, start=first
+                        ),
+                        data_provider.augment_rngs(ei, first),
+                        flip_labels=flip_labels,
+                        wait=data_provider.data_wait,
+                    )
+                else:
+                    train_batch_iter = data_provider.get_train_iter(
+                        self.batch_size, epoch=ei, start=first
+                    )
 
-                if counter % checkpoint_steps == 0:
+                # an interrupted epoch already had its decay
+                if (ei + 1) % schedule == 0 and not first:
+                    update_lr = current_lr / 2.0
+                    # minimum learning rate guarantee
+                    update_lr = max(update_lr, 0.0002)
                     print(
-                        log_format
-                        % (
-                            ei,
-                            bid,
-                            total_batches,
-                            passed,
+                        "decay learning rate from %.5f to %.5f"
+                        % (current_lr, update_lr)
+                    )
+                    current_lr = update_lr
+
+                for bid, batch in enumerate(train_batch_iter, first):
+                    profiler.begin_step()
+                    counter += 1
+                    # position once this step is done
+                    state.update(epoch=ei, batch=bid + 1, step=counter, lr=current_lr)
+                    if self.pipeline is not None:
+                        # the batch is already staged in the graph
+                        feed_dict = {learning_rate: current_lr}
+                    else:
+                        labels, codes, batch_images = batch
+                        shuffled_ids = labels[:]
+                        if flip_labels:
+                            data_provider.epoch_rng(ei, bid, 1).shuffle(shuffled_ids)
+                        feed_dict = {
+                            real_data: batch_images,
+                            embedding_ids: labels,
+                            learning_rate: current_lr,
+                            no_target_data: batch_images,
+                            no_target_ids: shuffled_ids,
+                        }
+                    checkpoint_due = counter % checkpoint_steps == 0 or (
+                        checkpoint_secs
+                        and time.time() - last_checkpoint >= checkpoint_secs
+                    )
+                    with_stats = counter % summary_steps == 0 or checkpoint_due
+                    if fused_step:
+                        _, *stats = run_step(
+                            "fused_update",
+                            [train_step] + (d_stats + g_stats if with_stats else []),
+                            feed_dict,
+                            counter,
+                        )
+                    else:
+                        # Optimize D
+                        _, *stats = run_step(
+                            "d_update",
+                            [d_optimizer] + (d_stats if with_stats else []),
+                            feed_dict,
+                            counter,
+                        )
+                        # Optimize G
+                        run_step("g_update", g_optimizer, feed_dict, counter)
+                        # magic move to Optimize G again
+                        # according to https://github.com/carpedm20/DCGAN-tensorflow
+                        # collect all the losses along the way
+                        _, *g_values = run_step(
+                            "g_update_2",
+                            [g_optimizer] + (g_stats if with_stats else []),
+                            feed_dict,
+                            counter,
+                        )
+                        stats += g_values
+                    passed = time.time() - start_time
+                    log_format = (
+                        "Epoch: [%2d], [%4d/%4d] time: %4.4f, d_loss: %.5f, g_loss: %.5f, "
+                        + "category_loss: %.5f, cheat_loss: %.5f, const_loss: %.5f, l1_loss: %.5f, tv_loss: %.5f"
+                    )
+                    #                print(log_format % (ei, bid, total_batches, passed, batch_d_loss, batch_g_loss,
+                    #                                    category_loss, cheat_loss, const_loss, l1_loss, tv_loss))
+                    if with_stats:
+                        (
                             batch_d_loss,
+                            d_summary,
                             batch_g_loss,
                             category_loss,
                             cheat_loss,
                             const_loss,
                             l1_loss,
                             tv_loss,
+                            g_summary,
+                        ) = stats
+                        if fused_step:
+                            g_summary = tf.Summary(
+                                value=[
+                                    tf.Summary.Value(tag=tag, simple_value=value)
+                                    for tag, value in zip(g_summary_tags, g_summary)
+                                ]
+                            )
+                        with profiler.phase("summary"):
+                            summary_writer.add_summary(d_summary, counter)
+                            summary_writer.add_summary(g_summary, counter)
+
+                    if (not no_val) and counter % sample_steps == 0:
+                        # sample the current model states with val data
+                        with profiler.phase("validate"):
+                            self.validate_model(val_batch_iter, ei, counter)
+
+                    if checkpoint_due:
+                        print(
+                            log_format
+                            % (
+                                ei,
+                                bid,
+                                total_batches,
+                                passed,
+                                batch_d_loss,
+                                batch_g_loss,
+                                category_loss,
+                                cheat_loss,
+                                const_loss,
+                                l1_loss,
+                                tv_loss,
+                            )
                         )
-                    )
-                    print("Checkpoint: save checkpoint step %d" % counter)
-                    self.checkpoint(saver, counter)
+                        data_wait = data_provider.data_wait
+                        print(
+                            "Data: waited %.2fs for %d batches, %.1f%% of the time"
+                            % (
+                                data_wait.seconds,
+                                data_wait.count,
+                                100 * data_wait.seconds / passed,
+                            )
+                        )
+                        print("Checkpoint: save checkpoint step %d" % counter)
+                        with profiler.phase("checkpoint"):
+                            self.checkpoint(saver, counter, state)
+                        last_checkpoint = time.time()
+                    profiler.end_step()
+                    if profile_steps and counter % profile_steps == 0:
+                        profiler.export(counter)
+                    if stop_signals:
+                        break
+                else:
+                    state.update(epoch=ei + 1, batch=0)
+                    continue
+                break
         # save the last checkpoint
         print("Checkpoint: last checkpoint step %d" % counter)
-        self.checkpoint(saver, counter)
+        self.checkpoint(saver, counter, state)
+        if async_checkpoint:
+            saver.close()
+        if stop_signals:
+            print("stopped at epoch %d, batch %d" % (state["epoch"], state["batch"]))
+            return
         with open(self.progress_file, "a") as f:
             f.write("Done")
+
+
+class UNetTF2(UNet):
+    """
+    The UNet model on the TF2 runtime: layers hold eager variables and the
+    train and generate steps are tf.function compiled, optionally by XLA.
+    Variables carry the names of the graph model, so checkpoints of either
+    load into the other. Adam moments are not shared and start over.
+    With a strategy, variables are mirrored over its replicas and every
+    step synchronizes the gradients
+    """
+
+    def __init__(
+        self,
+        *args,
+        inst_norm=False,
+        no_target_source=False,
+        jit_compile=False,
+        strategy=None,
+        **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        self.inst_norm = inst_norm
+        self.no_target_source = no_target_source
+        self.strategy = strategy
+        self.worker_index, self.worker_count = 0, 1
+        if strategy is not None:
+            self.worker_index = strategy.cluster_resolver.task_id or 0
+            self.worker_count = strategy.num_replicas_in_sync
+        # scope path -> layer, e.g. generator/g_e1_conv
+        self.layers: dict[str, Layer] = {}
+        if strategy is None:
+            self.build_layers()
+        else:
+            with strategy.scope():
+                self.build_layers()
+        self.d_vars: list[tf.Variable] = []
+        self.g_vars: list[tf.Variable] = []
+        if strategy is None:
+            self.train_step = tf.function(self._train_step, jit_compile=jit_compile)
+        else:
+            # collectives do not compile with XLA, the step runs as a graph
+            self.train_step = tf.function(self._distributed_train_step)
+        self.evaluate_step = tf.function(self._evaluate_step, jit_compile=jit_compile)
+        self.generate_step = tf.function(self._generate_step, jit_compile=jit_compile)
+
+    @property
+    def is_chief(self):
+        return self.worker_index == 0
+
+    def build_layers(self):
+        g = self.generator_dim
+        encoder_filters = [g, g * 2, g * 4, g * 8, g * 8, g * 8, g * 8, g * 8]
+        self.encode_layers = [
+            self.add_layer(
+                "generator",
+                Conv2d(self.output_filters, encoder_filters[0], scope="g_e1_conv"),
+            )
+        ]
+        for layer in range(2, 9):
+            conv = Conv2d(
+                encoder_filters[layer - 2],
+                encoder_filters[layer - 1],
+                scope="g_e%d_conv" % layer,
+            )
+            bn = BatchNorm(encoder_filters[layer - 1], scope="g_e%d_bn" % layer)
+            self.add_layer("generator", conv)
+            self.encode_layers.append((conv, self.add_layer("generator", bn)))
+
+        decoder_filters = [g * 8, g * 8, g * 8, g * 8, g * 4, g * 2, g]
+        decoder_filters.append(self.output_filters)
+        self.decode_layers = []
+        input_filters = encoder_filters[-1] + self.embedding_dim
+        for layer in range(1, 9):
+            output_filters = decoder_filters[layer - 1]
+            deconv = self.add_layer(
+                "generator",
+                Deconv2d(input_filters, output_filters, scope="g_d%d_deconv" % layer),
+            )
+            norm = None
+            if layer != 8 and self.inst_norm:
+                norm = ConditionalInstanceNorm(
+                    self.embedding_num,
+                    output_filters,
+                    scope="g_d%d_inst_norm" % layer,
+                )
+            elif layer != 8:
+                norm = BatchNorm(output_filters, scope="g_d%d_bn" % layer)
+            if norm is not None:
+                self.add_layer("generator", norm)
+            self.decode_layers.append((deconv, norm))
+            if layer != 8:
+                # concatenated with the encoder layer of the same width
+                input_filters = output_filters + encoder_filters[7 - layer]
+
+        d = self.discriminator_dim
+        pair_filters = self.input_filters + self.output_filters
+        self.d_h0_conv = self.add_layer(
+            "discriminator", Conv2d(pair_filters, d, scope="d_h0_conv")
+        )
+        self.d_layers = []
+        for layer, (sh, sw) in enumerate([(2, 2), (2, 2), (1, 1)], 1):
+            conv = Conv2d(
+                d * 2 ** (layer - 1),
+                d * 2**layer,
+                sh=sh,
+                sw=sw,
+                scope="d_h%d_conv" % layer,
+            )
+            bn = BatchNorm(d * 2**layer, scope="d_bn_%d" % layer)
+            self.add_layer("discriminator", conv)
+            self.d_layers.append((conv, self.add_layer("discriminator", bn)))
+        features = (self.input_width // 8) ** 2 * d * 8
+        self.d_fc1 = self.add_layer("discriminator", Fc(features, 1, scope="d_fc1"))
+        self.d_fc2 = self.add_layer(
+            "discriminator", Fc(features, self.embedding_num, scope="d_fc2")
+        )
+
+        self.embedding = Embedding(self.embedding_num, self.embedding_dim)
+        self.layers[self.embedding.scope] = self.embedding
+
+        self.d_optimizer = tf.keras.optimizers.Adam(beta_1=0.5)
+        self.g_optimizer = tf.keras.optimizers.Adam(beta_1=0.5)
+
+    def add_layer(self, root, layer):
+        self.layers["%s/%s" % (root, layer.scope)] = layer
+        return layer
+
+    def variables_by_name(self):
+        """
+        Every variable under the name the graph model gives it
+        """
+        return {
+            "%s/%s" % (path, name): var
+            for path, layer in self.layers.items()
+            for name, var in layer.weights.items()
+        }
+
+    def retrieve_trainable_vars(self, freeze_encoder=False):
+        names = self.variables_by_name()
+        d_vars = [
+            var
+            for name, var in names.items()
+            if name.startswith("discriminator/") and var.trainable
+        ]
+        g_vars = [
+            var
+            for name, var in names.items()
+            if name.startswith("generator/") and var.trainable
+        ]
+        if freeze_encoder:
+            # exclude encoder weights
+            print("freeze encoder weights")
+            g_vars = [
+                var
+                for name, var in names.items()
+                if name.startswith("generator/g_d") and var.trainable
+            ]
+        return g_vars, d_vars
+
+    def encoder(self, images, is_training):
+        e1 = self.encode_layers[0](images)
+        encode_layers = [e1]
+        x = e1
+        for conv, bn in self.encode_layers[1:]:
+            x = bn(conv(lrelu(x)), is_training)
+            encode_layers.append(x)
+        return x, encode_layers
+
+    def decoder(self, encoded, encoding_layers, ids, is_training):
+        x = encoded
+        for layer, (deconv, norm) in enumerate(self.decode_layers, 1):
+            # the widths of the graph model, 1 for the first layer at 128
+            x = deconv(tf.nn.relu(x), int(self.output_width / 2 ** (8 - layer)))
+            if layer == 8:
+                break
+            if self.inst_norm:
+                x = norm(x, ids)
+            else:
+                x = norm(x, is_training)
+            if layer <= 3:
+                x = tf.nn.dropout(x, rate=0.5)
+            x = tf.concat([x, encoding_layers[7 - layer]], 3)
+        return tf.nn.tanh(x)  # scale to (-1, 1)
+
+    def generator(self, images, embedding_ids, is_training):
+        e8, enc_layers = self.encoder(images, is_training)
+        local_embeddings = tf.gather(self.embedding.E, embedding_ids)
+        embedded = tf.concat([e8, local_embeddings], 3)
+        output = self.decoder(embedded, enc_layers, embedding_ids, is_training)
+        return output, e8
+
+    def discriminator(self, image, is_training):
+        h = lrelu(self.d_h0_conv(image))
+        for conv, bn in self.d_layers:
+            h = lrelu(bn(conv(h), is_training))
+        h = tf.reshape(h, [tf.shape(h)[0], -1])
+        fc1 = self.d_fc1(h)
+        return tf.nn.sigmoid(fc1), fc1, self.d_fc2(h)
+
+    def losses(
+        self, real_data, embedding_ids, no_target_data, no_target_ids, is_training
+    ):
+        """
+        The losses of build_model, with the generated and target images
+        """
+        # target images
+        real_B = real_data[:, :, :, : self.input_filters]
+        # source images
+        real_A = real_data[
+            :, :, :, self.input_filters : self.input_filters + self.output_filters
+        ]
+        fake_B, encoded_real_A = self.generator(real_A, embedding_ids, is_training)
+        real_AB = tf.concat([real_A, real_B], 3)
+        fake_AB = tf.concat([real_A, fake_B], 3)
+        real_D, real_D_logits, real_category_logits = self.discriminator(
+            real_AB, is_training
+        )
+        fake_D, fake_D_logits, fake_category_logits = self.discriminator(
+            fake_AB, is_training
+        )
+
+        encoded_fake_B = self.encoder(fake_B, is_training)[0]
+        const_loss = (
+            tf.reduce_mean(tf.square(encoded_real_A - encoded_fake_B))
+        ) * self.Lconst_penalty
+
+        true_labels = tf.one_hot(embedding_ids, depth=self.embedding_num)
+        real_category_loss = tf.reduce_mean(
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                logits=real_category_logits, labels=true_labels
+            )
+        )
+        fake_category_loss = tf.reduce_mean(
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                logits=fake_category_logits, labels=true_labels
+            )
+        )
+        category_loss = self.Lcategory_penalty * (
+            real_category_loss + fake_category_loss
+        )
+
+        d_loss_real = tf.reduce_mean(
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                logits=real_D_logits, labels=tf.ones_like(real_D)
+            )
+        )
+        d_loss_fake = tf.reduce_mean(
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                logits=fake_D_logits, labels=tf.zeros_like(fake_D)
+            )
+        )
+        l1_loss = self.L1_penalty * tf.reduce_mean(tf.abs(fake_B - real_B))
+        width = self.output_width
+        tv_loss = (
+            tf.nn.l2_loss(fake_B[:, 1:, :, :] - fake_B[:, : width - 1, :, :]) / width
+            + tf.nn.l2_loss(fake_B[:, :, 1:, :] - fake_B[:, :, : width - 1, :]) / width
+        ) * self.Ltv_penalty
+        cheat_loss = tf.reduce_mean(
+            tf.nn.sigmoid_cross_entropy_with_logits(
+                logits=fake_D_logits, labels=tf.ones_like(fake_D)
+            )
+        )
+
+        d_loss = d_loss_real + d_loss_fake + category_loss / 2.0
+        g_loss = (
+            cheat_loss
+            + l1_loss
+            + self.Lcategory_penalty * fake_category_loss
+            + const_loss
+            + tv_loss
+        )
+
+        if self.no_target_source:
+            no_target_A = no_target_data[
+                :, :, :, self.input_filters : self.input_filters + self.output_filters
+            ]
+            no_target_B, encoded_no_target_A = self.generator(
+                no_target_A, no_target_ids, is_training
+            )
+            no_target_labels = tf.one_hot(no_target_ids, depth=self.embedding_num)
+            no_target_AB = tf.concat([no_target_A, no_target_B], 3)
+            (
+                no_target_D,
+                no_target_D_logits,
+                no_target_category_logits,
+            ) = self.discriminator(no_target_AB, is_training)
+            encoded_no_target_B = self.encoder(no_target_B, is_training)[0]
+            no_target_const_loss = (
+                tf.reduce_mean(tf.square(encoded_no_target_A - encoded_no_target_B))
+                * self.Lconst_penalty
+            )
+            no_target_category_loss = (
+                tf.reduce_mean(
+                    tf.nn.sigmoid_cross_entropy_with_logits(
+                        logits=no_target_category_logits, labels=no_target_labels
+                    )
+                )
+                * self.Lcategory_penalty
+            )
+            d_loss_no_target = tf.reduce_mean(
+                tf.nn.sigmoid_cross_entropy_with_logits(
+                    logits=no_target_D_logits, labels=tf.zeros_like(no_target_D)
+                )
+            )
+            cheat_loss += tf.reduce_mean(
+                tf.nn.sigmoid_cross_entropy_with_logits(
+                    logits=no_target_D_logits, labels=tf.ones_like(no_target_D)
+                )
+            )
+            d_loss = (
+                d_loss_real
+                + d_loss_fake
+                + d_loss_no_target
+                + (category_loss + no_target_category_loss) / 3.0
+            )
+            g_loss = (
+                cheat_loss / 2.0
+                + l1_loss
+                + (
+                    self.Lcategory_penalty * fake_category_loss
+                    + no_target_category_loss
+                )
+                / 2.0
+                + (const_loss + no_target_const_loss) / 2.0
+                + tv_loss
+            )
+
+        loss_handle = LossHandle(
+            d_loss=d_loss,
+            g_loss=g_loss,
+            const_loss=const_loss,
+            l1_loss=l1_loss,
+            category_loss=category_loss,
+            cheat_loss=cheat_loss,
+            tv_loss=tv_loss,
+        )
+        return loss_handle, fake_B, real_B
+
+    def _train_step(self, real_data, embedding_ids, no_target_data, no_target_ids):
+        inputs = (real_data, embedding_ids, no_target_data, no_target_ids)
+        # optimizers sum the gradients of all replicas
+        scale = 1.0 / tf.distribute.get_strategy().num_replicas_in_sync
+        # Optimize D
+        with tf.GradientTape() as tape:
+            d_loss = self.losses(*inputs, is_training=True)[0].d_loss
+            scaled_loss = d_loss * scale
+        grads = tape.gradient(scaled_loss, self.d_vars)
+        self.d_optimizer.apply_gradients(zip(grads, self.d_vars))
+        # Optimize G twice, each after a new forward pass
+        for _ in range(2):
+            with tf.GradientTape() as tape:
+                loss_handle = self.losses(*inputs, is_training=True)[0]
+                scaled_loss = loss_handle.g_loss * scale
+            grads = tape.gradient(scaled_loss, self.g_vars)
+            self.g_optimizer.apply_gradients(zip(grads, self.g_vars))
+        return loss_handle._replace(d_loss=d_loss)
+
+    def _distributed_train_step(self, *inputs_and_stop):
+        """
+        One train step on every replica, each with its own batch, and the
+        stop requests of this worker. Returns the losses averaged over the
+        replicas and the stop requests of all of them
+        """
+
+        def replica_step(*inputs_and_stop):
+            *inputs, stop = inputs_and_stop
+            context = tf.distribute.get_replica_context()
+            # an input as is has no device for the collective to run on
+            stop = context.all_reduce(tf.distribute.ReduceOp.SUM, tf.identity(stop))
+            return self._train_step(*inputs), stop
+
+        losses, stop = self.strategy.run(replica_step, args=inputs_and_stop)
+        losses = tf.nest.map_structure(
+            lambda loss: self.strategy.reduce(
+                tf.distribute.ReduceOp.MEAN, loss, axis=None
+            ),
+            losses,
+        )
+        # already summed over the replicas, alike on every one of them
+        return losses, self.strategy.experimental_local_results(stop)[0]
+
+    def _evaluate_step(self, real_data, embedding_ids):
+        loss_handle, fake_B, real_B = self.losses(
+            real_data, embedding_ids, real_data, embedding_ids, is_training=False
+        )
+        return (
+            fake_B,
+            real_B,
+            loss_handle.d_loss,
+            loss_handle.g_loss,
+            loss_handle.l1_loss,
+        )
+
+    def _generate_step(self, source_images, embedding_ids):
+        return self.generator(source_images, embedding_ids, is_training=False)[0]
+
+    def generate_fake_samples(self, input_images, embedding_ids):
+        return [
+            t.numpy()
+            for t in self.evaluate_step(
+                tf.convert_to_tensor(input_images, tf.float32),
+                tf.convert_to_tensor(embedding_ids, tf.int64),
+            )
+        ]
+
+    def generate(self, source_images, embedding_ids):
+        """
+        Generated images of the (batch, w, h, filters) sources
+        """
+        return self.generate_step(
+            tf.convert_to_tensor(source_images, tf.float32),
+            tf.convert_to_tensor(embedding_ids, tf.int64),
+        ).numpy()
+
+    def generate_fake_images(self, input_images, embedding_ids):
+        # only the generator runs, on the source half of the examples
+        source = input_images[
+            :, :, :, self.input_filters : self.input_filters + self.output_filters
+        ]
+        return self.generate(source, embedding_ids)
+
+    def restore_generator(self, model_dir):
+        generator_vars = {
+            name: var
+            for name, var in self.variables_by_name().items()
+            if "embedding" in name or "g_" in name
+        }
+        self.restore_model(generator_vars, model_dir)
+
+    def restore_model(self, variables, model_dir):
+        """
+        Restore the name -> variable of variables from the latest checkpoint,
+        by name, which takes variables mirrored by a strategy, unlike Saver.
+        Returns the path of the restored checkpoint, None without one
+        """
+        ckpt = tf.train.get_checkpoint_state(model_dir)
+        if not ckpt:
+            print("fail to restore model %s" % model_dir)
+            return None
+        reader = tf.train.load_checkpoint(ckpt.model_checkpoint_path)
+        for name, var in variables.items():
+            var.assign(reader.get_tensor(name))
+        print("restored model %s" % model_dir)
+        return ckpt.model_checkpoint_path
+
+    def checkpoint(self, saver, step, state=None):
+        if self.is_chief:
+            return super().checkpoint(saver, step, state)
+        # reading the variables takes every worker, only the chief keeps them
+        saver.snapshot()
+
+    def validate_model(self, val_iter, epoch, step):
+        if self.is_chief:
+            return super().validate_model(val_iter, epoch, step)
+        # take part in reading the variables, samples are the chief's
+        labels, codes, images = next(val_iter)
+        self.generate_fake_samples(images, labels)
+
+    def saver(self, max_to_keep=3):
+        """
+        Saver of the graph model's format and names, usable eagerly
+        """
+        return tf.compat.v1.train.Saver(
+            var_list=self.variables_by_name(), max_to_keep=max_to_keep
+        )
+
+    def train(
+        self,
+        lr=0.0002,
+        epoch=100,
+        schedule=10,
+        resume=True,
+        flip_labels=False,
+        freeze_encoder=False,
+        fine_tune=None,
+        sample_steps=50,
+        checkpoint_steps=500,
+        no_val=False,
+        decode_budget=0,
+        prefetch_depth=0,
+        prefetch_workers=1,
+        balance_labels=None,
+        fixed_val_batches=0,
+        summary_steps=1,
+        seed=None,
+        checkpoint_secs=0,
+        async_checkpoint=True,
+        profile_steps=0,
+        trace_steps=None,
+    ):
+        """
+        Train on the data of experiment_dir. Every worker of a strategy runs
+        this with the same arguments, seed included, so they agree on the
+        batches they share out
+        """
+        self.g_vars, self.d_vars = self.retrieve_trainable_vars(
+            freeze_encoder=freeze_encoder
+        )
+        if self.is_chief:
+            with open(self.progress_file, "a") as f:
+                f.write("Start")
+
+        saver = self.saver()
+        summary_writer = tf.summary.create_file_writer(self.log_dir)
+
+        state = None
+        if resume:
+            _, model_dir = self.get_model_id_and_dir()
+            checkpoint_path = self.restore_model(self.variables_by_name(), model_dir)
+            if checkpoint_path:
+                state = self.load_train_state(model_dir, checkpoint_path)
+        if state is None:
+            state = {"epoch": 0, "batch": 0, "step": 0, "lr": lr, "seed": seed}
+        if self.strategy is not None and not async_checkpoint:
+            # a Saver takes no mirrored variables, their values are copied out
+            print("workers write checkpoints in the background")
+            async_checkpoint = True
+        if async_checkpoint:
+            saver = AsyncCheckpointer(self.variables_by_name(), max_to_keep=3)
+        if checkpoint_secs and self.worker_count > 1:
+            # workers would disagree on the time, and checkpoints take them all
+            print("workers checkpoint every checkpoint_steps only")
+            checkpoint_secs = 0
+
+        data_provider = TrainDataProvider(
+            self.data_dir,
+            filter_by=fine_tune,
+            no_val=no_val,
+            decode_budget=decode_budget,
+            prefetch_depth=prefetch_depth,
+            prefetch_workers=prefetch_workers,
+            balance=balance_labels,
+            seed=state["seed"],
+            shard=(self.worker_index, self.worker_count),
+        )
+        state["seed"] = int(data_provider.seed)
+        total_batches = data_provider.compute_shard_batch_num(self.batch_size)
+        if not no_val and fixed_val_batches:
+            val_batch_iter = data_provider.get_fixed_val_iter(
+                self.batch_size, fixed_val_batches
+            )
+        elif not no_val:
+            val_batch_iter = data_provider.get_val_iter(self.batch_size)
+
+        current_lr = state["lr"]
+        counter = state["step"]
+        start_epoch, start_batch = state["epoch"], state["batch"]
+        start_time = time.time()
+        last_checkpoint = start_time
+        start_step = counter
+        profiler = self.step_profiler(trace_steps)
+        stopping = False
+        with stop_requests() as stop_signals:
+            for ei in range(start_epoch, epoch):
+                first = start_batch if ei == start_epoch else 0
+                train_batch_iter = data_provider.get_train_iter(
+                    self.batch_size, epoch=ei, start=first
+                )
+                if (ei + 1) % schedule == 0 and not first:
+                    update_lr = max(current_lr / 2.0, 0.0002)
+                    print(
+                        "decay learning rate from %.5f to %.5f"
+                        % (current_lr, update_lr)
+                    )
+                    current_lr = update_lr
+                self.d_optimizer.learning_rate = current_lr
+                self.g_optimizer.learning_rate = current_lr
+
+                for bid, (labels, codes, batch_images) in enumerate(
+                    train_batch_iter, first
+                ):
+                    profiler.begin_step()
+                    counter += 1
+                    state.update(epoch=ei, batch=bid + 1, step=counter, lr=current_lr)
+                    shuffled_ids = labels[:]
+                    if flip_labels:
+                        data_provider.epoch_rng(ei, bid, 1).shuffle(shuffled_ids)
+                    inputs = (
+                        tf.convert_to_tensor(batch_images, tf.float32),
+                        tf.convert_to_tensor(labels, tf.int64),
+                        tf.convert_to_tensor(batch_images, tf.float32),
+                        tf.convert_to_tensor(shuffled_ids, tf.int64),
+                    )
+                    if trace_steps and counter == trace_steps[0]:
+                        tf.profiler.experimental.start(self.log_dir)
+                    with profiler.phase("train_step"):
+                        if self.strategy is None:
+                            loss_handle = self.train_step(*inputs)
+                            stopping = bool(stop_signals)
+                        else:
+                            # workers stop after the same step, or the others
+                            # would block in the collectives of the next one
+                            loss_handle, stop_votes = self.train_step(
+                                *inputs, tf.constant(len(stop_signals), tf.int32)
+                            )
+                            stopping = int(stop_votes) > 0
+                    if trace_steps and counter == trace_steps[1]:
+                        tf.profiler.experimental.stop()
+                    if self.is_chief and counter % summary_steps == 0:
+                        with profiler.phase("summary"), summary_writer.as_default():
+                            for name, value in loss_handle._asdict().items():
+                                tf.summary.scalar(name, value, step=counter)
+
+                    if (not no_val) and counter % sample_steps == 0:
+                        with profiler.phase("validate"):
+                            self.validate_model(val_batch_iter, ei, counter)
+
+                    if counter % checkpoint_steps == 0 or (
+                        checkpoint_secs
+                        and time.time() - last_checkpoint >= checkpoint_secs
+                    ):
+                        passed = time.time() - start_time
+                        examples = (
+                            (counter - start_step) * self.batch_size * self.worker_count
+                        )
+                        print(
+                            "Epoch: [%2d], [%4d/%4d] time: %4.4f, %.1f examples/s, "
+                            % (ei, bid, total_batches, passed, examples / passed)
+                            + ", ".join(
+                                "%s: %.5f" % (name, value)
+                                for name, value in loss_handle._asdict().items()
+                            )
+                        )
+                        print("Checkpoint: save checkpoint step %d" % counter)
+                        with profiler.phase("checkpoint"):
+                            self.checkpoint(saver, counter, state)
+                        last_checkpoint = time.time()
+                    profiler.end_step()
+                    if self.is_chief and profile_steps and counter % profile_steps == 0:
+                        profiler.export(counter)
+                    if stopping:
+                        break
+                else:
+                    state.update(epoch=ei + 1, batch=0)
+                    continue
+                break
+        # every worker takes part, only the chief keeps it
+        print("Checkpoint: last checkpoint step %d" % counter)
+        self.checkpoint(saver, counter, state)
+        if async_checkpoint:
+            saver.close()
+        if stopping:
+            print("stopped at epoch %d, batch %d" % (state["epoch"], state["batch"]))
+            return
+        if self.is_chief:
+            with open(self.progress_file, "a") as f:
+                f.write("Done")
@@ -1,9 +1,233 @@
+import collections
 import glob
+import hashlib
+import io
+import json
 import os
 import pickle
-import random
+import time
+from collections.abc import Callable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import TypeVar
 
 import click
+import numpy as np
+from PIL import Image
+
+from neural_fonts.model.columnar import BIT_DEPTHS, ColumnarWriter
+from neural_fonts.model.sharded import ShardedWriter
+
+DATASET_FORMATS = ["pickle", "columnar"]
+
+T = TypeVar("T")
+Payload = TypeVar("Payload", bytes, np.ndarray)
+
+
+class DatasetWriter:
+    """
+    Pickle rendered examples straight into train.obj / val.obj as
+    (label, code, uint8 array) records, skipping the PNG round trip.
+    Examples without a fixed split are assigned by split_hash, and with
+    drop_duplicates, duplicates are dropped like pickle_examples does.
+    With format="columnar" both files are written in the columnar layout
+    """
+
+    encoding = "raw"
+
+    def __init__(
+        self,
+        save_dir: str,
+        train_val_split: float = 0.1,
+        format: str = "pickle",
+        drop_duplicates: bool = False,
+    ):
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        self.train_val_split = train_val_split
+        train_path = os.path.join(save_dir, "train.obj")
+        val_path = os.path.join(save_dir, "val.obj")
+        self.columnar = format == "columnar"
+        if self.columnar:
+            self.train_file = ColumnarWriter(train_path)
+            self.val_file = ColumnarWriter(val_path)
+        else:
+            self.train_file = open(train_path, "wb")
+            self.val_file = open(val_path, "wb")
+        self.duplicates = DuplicateFilter() if drop_duplicates else None
+
+    def write(
+        self, label: int, code: str, split: str | None, data: bytes | np.ndarray
+    ) -> None:
+        digest = content_hash(data)
+        if self.duplicates is not None and self.duplicates.seen(label, digest):
+            return
+        if split is None:
+            split = "val" if split_hash(label, code) < self.train_val_split else "train"
+        f = self.val_file if split == "val" else self.train_file
+        if isinstance(f, ColumnarWriter):
+            f.write(label, code, data, digest)
+        else:
+            pickle.dump((label, code, data), f)
+
+    def close(self) -> None:
+        self.train_file.close()
+        self.val_file.close()
+        if self.duplicates is not None:
+            self.duplicates.report()
+
+
+class Progress:
+    """
+    Report progress at most once every interval seconds
+    """
+
+    def __init__(self, total: int, what: str = "examples", interval: float = 5.0):
+        self.total = total
+        self.what = what
+        self.interval = interval
+        self.done = 0
+        self.start = self.last = time.monotonic()
+
+    def update(self, n: int = 1) -> None:
+        self.done += n
+        now = time.monotonic()
+        if now - self.last >= self.interval or self.done == self.total:
+            self.last = now
+            rate = self.done / max(now - self.start, 1e-9)
+            print(f"{self.done}/{self.total} {self.what} ({rate:.0f}/s)")
+
+
+def example_fields(path: str) -> tuple[int, str]:
+    """
+    Label and code of an example from its name, label_code[_split].png
+    """
+    fields = os.path.splitext(os.path.basename(path))[0].split("_")
+    return int(fields[0]), fields[1] if len(fields) > 1 else ""
+
+
+def read_png(path: str) -> bytes | None:
+    """
+    Read an example, None when it is not a valid PNG
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    try:
+        with Image.open(io.BytesIO(data)) as img:
+            if img.format != "PNG":
+                return None
+            img.verify()
+    except (OSError, SyntaxError):
+        return None
+    return data
+
+
+def decode_png(path: str) -> np.ndarray | None:
+    """
+    Decode an example to a grayscale array, None when it can not be read
+    """
+    try:
+        with Image.open(path) as img:
+            return np.asarray(img.convert("L"))
+    except (OSError, SyntaxError):
+        return None
+
+
+def read_examples(
+    paths: list[str],
+    load: Callable[[str], T | None],
+    workers: int = 1,
+) -> Iterator[tuple[str, T]]:
+    """
+    Load examples with a pool of threads, yielding them in the order of
+    paths so the packaged files do not depend on scheduling.
+    Invalid examples are reported and skipped
+    """
+    progress = Progress(len(paths))
+
+    def results() -> Iterator[T | None]:
+        if workers <= 1:
+            yield from map(load, paths)
+            return
+        with ThreadPoolExecutor(workers) as executor:
+            pending: collections.deque[Future[T | None]] = collections.deque()
+            for p in paths:
+                pending.append(executor.submit(load, p))
+                if len(pending) >= workers * 4:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    for p, example in zip(paths, results()):
+        progress.update()
+        if example is None:
+            print(f"skip invalid example {p}")
+            continue
+        yield p, example
+
+
+def content_hash(data: bytes | np.ndarray) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def split_hash(label: int, code: str, seed: int | None = None) -> float:
+    """
+    Uniform value in [0, 1) fixed by the label and character of an example,
+    so every rebuild assigns it to the same split
+    """
+    key = f"{label}_{code}" if seed is None else f"{seed}_{label}_{code}"
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big") / 2**64
+
+
+class DuplicateFilter:
+    """
+    Recognize examples with the same label and image as an earlier one,
+    which every way of packaging drops with drop_duplicates
+    """
+
+    def __init__(self):
+        self.digests: set[tuple[int, bytes]] = set()
+        self.dropped = 0
+
+    def seen(self, label: int, digest: bytes) -> bool:
+        if (label, digest) in self.digests:
+            self.dropped += 1
+            return True
+        self.digests.add((label, digest))
+        return False
+
+    def report(self) -> None:
+        if self.dropped:
+            print(f"dropped {self.dropped} duplicate examples")
+
+
+def hashed_examples(
+    examples: Iterator[tuple[str, Payload]], drop_duplicates: bool = False
+) -> Iterator[tuple[str, int, str, Payload, bytes]]:
+    """
+    Attach label, code and content hash to examples, dropping duplicates
+    with drop_duplicates
+    """
+    duplicates = DuplicateFilter()
+    for p, data in examples:
+        label, code = example_fields(p)
+        digest = content_hash(data)
+        if not (drop_duplicates and duplicates.seen(label, digest)):
+            yield p, label, code, data, digest
+    duplicates.report()
+
+
+def is_val_example(
+    path: str,
+    label: int,
+    code: str,
+    train_val_split: float,
+    fixed_sample: bool,
+    seed: int | None = None,
+) -> bool:
+    if fixed_sample:
+        return "val" in path
+    return split_hash(label, code, seed) < train_val_split
 
 
 def pickle_examples(
@@ -12,43 +236,161 @@ def pickle_examples(
     val_path: str,
     train_val_split: float = 0.1,
     fixed_sample: bool = False,
+    append: bool = False,
+    workers: int = 1,
+    seed: int | None = None,
+    shard_size: int = 0,
+    drop_duplicates: bool = False,
 ) -> None:
     """
     Compile a list of examples into pickled format, so during
-    the training, all io will happen in memory
+    the training, all io will happen in memory.
+    With shard_size, train/val are indexes over shards of that many
+    examples, streamed during the training instead
     """
-    if fixed_sample:
-        with open(train_path, "wb") as ft:
-            with open(val_path, "wb") as fv:
-                for p in paths:
-                    label = int(os.path.basename(p).split("_")[0])
-                    uni = os.path.basename(p).split("_")[1]
-                    with open(p, "rb") as f:
-                        # print(f"img {p}", label)
-                        image_bytes = f.read()
-                        example = (label, uni, image_bytes)
-                        if "val" in p:
-                            # validation set
-                            # print(f"img {p} is saved in val.obj")
-                            pickle.dump(example, fv)
-                        else:
-                            # training set
-                            # print(f"img {p} is saved in train.obj")
-                            pickle.dump(example, ft)
-                return
-    with open(train_path, "wb") as ft:
-        with open(val_path, "wb") as fv:
-            for p in paths:
-                label = int(os.path.basename(p).split("_")[0])
-                with open(p, "rb") as f:
-                    print("img %s" % p, label)
-                    image_bytes = f.read()
-                    r = random.random()
-                    example = (label, image_bytes)
-                    if r < train_val_split:
-                        pickle.dump(example, fv)
-                    else:
-                        pickle.dump(example, ft)
+    if shard_size:
+        ft = ShardedWriter(train_path, shard_size)
+        fv = ShardedWriter(val_path, shard_size)
+    else:
+        mode = "ab" if append else "wb"
+        ft, fv = open(train_path, mode), open(val_path, mode)
+    with ft, fv:
+        examples = hashed_examples(
+            read_examples(paths, read_png, workers), drop_duplicates
+        )
+        for p, label, code, image_bytes, _ in examples:
+            is_val = is_val_example(p, label, code, train_val_split, fixed_sample, seed)
+            f = fv if is_val else ft
+            if isinstance(f, ShardedWriter):
+                f.write(label, code, image_bytes)
+            else:
+                pickle.dump((label, code, image_bytes), f)
+
+
+def columnar_examples(
+    paths: list[str],
+    train_path: str,
+    val_path: str,
+    train_val_split: float = 0.1,
+    fixed_sample: bool = False,
+    workers: int = 1,
+    seed: int | None = None,
+    depth: int = 8,
+    exact_edges: bool = False,
+    drop_duplicates: bool = False,
+) -> None:
+    """
+    Decode a list of examples once into columnar train/val files,
+    which the training providers memory map instead of unpickling.
+    Images are quantized to depth bits, see ColumnarWriter
+    """
+    ft = ColumnarWriter(train_path, depth=depth, exact_edges=exact_edges)
+    fv = ColumnarWriter(val_path, depth=depth, exact_edges=exact_edges)
+    with ft, fv:
+        examples = hashed_examples(
+            read_examples(paths, decode_png, workers), drop_duplicates
+        )
+        for p, label, code, image, digest in examples:
+            is_val = is_val_example(p, label, code, train_val_split, fixed_sample, seed)
+            (fv if is_val else ft).write(label, code, image, digest)
+
+
+def example_signatures(paths: list[str], manifest_path: str) -> dict[str, str]:
+    """
+    Identify the content of each example file: its render key from the
+    font2img manifest when there is one, else its size and mtime
+    """
+    keys: dict[str, str] = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry["file"]:
+                    keys[entry["file"]] = entry["key"]
+    signatures: dict[str, str] = {}
+    for p in paths:
+        name = os.path.basename(p)
+        if name in keys:
+            signatures[name] = keys[name]
+        else:
+            stat = os.stat(p)
+            signatures[name] = f"{stat.st_size}-{stat.st_mtime_ns}"
+    return signatures
+
+
+def pickle_new_examples(
+    example_dir: str,
+    save_dir: str,
+    train_val_split: float = 0.1,
+    fixed_sample: bool = False,
+    format: str = "pickle",
+    workers: int = 1,
+    seed: int | None = None,
+    shard_size: int = 0,
+    depth: int = 8,
+    exact_edges: bool = False,
+    drop_duplicates: bool = False,
+) -> None:
+    """
+    Append only the examples added since the last run to train.obj/val.obj.
+    Falls back to packaging everything again when a packaged example
+    changed or disappeared, or when the files are columnar or sharded
+    """
+    train_path = os.path.join(save_dir, "train.obj")
+    val_path = os.path.join(save_dir, "val.obj")
+    state_path = os.path.join(save_dir, "packaged.json")
+    paths = sorted(glob.glob(os.path.join(example_dir, "*.png")))
+    signatures = example_signatures(paths, os.path.join(example_dir, "manifest.jsonl"))
+
+    packaged: dict[str, str] = {}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            packaged = json.load(f)
+    append = (
+        format == "pickle"
+        and not shard_size
+        and bool(packaged)
+        and os.path.exists(train_path)
+        and os.path.exists(val_path)
+        and all(signatures.get(name) == sig for name, sig in packaged.items())
+    )
+    if append:
+        paths = [p for p in paths if os.path.basename(p) not in packaged]
+        print(f"append {len(paths)} new examples")
+    else:
+        print(f"package all {len(paths)} examples")
+
+    if format == "columnar":
+        columnar_examples(
+            paths,
+            train_path=train_path,
+            val_path=val_path,
+            train_val_split=train_val_split,
+            fixed_sample=fixed_sample,
+            workers=workers,
+            seed=seed,
+            depth=depth,
+            exact_edges=exact_edges,
+            drop_duplicates=drop_duplicates,
+        )
+    else:
+        pickle_examples(
+            paths,
+            train_path=train_path,
+            val_path=val_path,
+            train_val_split=train_val_split,
+            fixed_sample=fixed_sample,
+            append=append,
+            workers=workers,
+            seed=seed,
+            shard_size=shard_size,
+            drop_duplicates=drop_duplicates,
+        )
+    with open(state_path, "w") as f:
+        json.dump(signatures, f)
 
 
 @click.command()
@@ -70,21 +412,123 @@ def pickle_examples(
     default=False,
     help="binarize fixed samples (we distinguish train/validation data with its filename).",
 )
-def main(dir: str, save_dir: str, split_ratio: float, fixed_sample: bool) -> None:
+@click.option(
+    "--incremental",
+    type=bool,
+    default=False,
+    help="only append examples added since the last package run to save-dir",
+)
+@click.option(
+    "--format",
+    type=click.Choice(DATASET_FORMATS),
+    default="pickle",
+    help="pickled PNG records, or decoded images in a memory mappable layout",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=os.cpu_count() or 1,
+    help="number of threads reading and validating examples",
+)
+@click.option(
+    "--seed",
+    type=int,
+    default=None,
+    help="salt of the train/val split, which is otherwise a fixed function "
+    "of label and character",
+)
+@click.option(
+    "--shard-size",
+    type=int,
+    default=0,
+    help="write pickled examples into shards of this many examples with an index, "
+    "for datasets larger than memory",
+)
+@click.option(
+    "--bit-depth",
+    type=click.Choice([str(depth) for depth in BIT_DEPTHS]),
+    default="8",
+    help="bits per pixel of columnar images, glyphs are nearly binary",
+)
+@click.option(
+    "--exact-edges",
+    type=bool,
+    default=False,
+    help="keep exact values of the pixels quantization changed, with --bit-depth",
+)
+@click.option(
+    "--drop-duplicates",
+    type=bool,
+    default=False,
+    help="drop examples with the same label and image as an earlier one, "
+    "columnar files store identical images once either way",
+)
+def main(
+    dir: str,
+    save_dir: str,
+    split_ratio: float,
+    fixed_sample: bool,
+    incremental: bool,
+    format: str,
+    workers: int,
+    seed: int | None,
+    shard_size: int,
+    bit_depth: str,
+    exact_edges: bool,
+    drop_duplicates: bool,
+) -> None:
     """
     Compile list of images into a pickled object for training
     """
+    if shard_size and format != "pickle":
+        raise click.UsageError("--shard-size only applies to the pickle format")
+    if bit_depth != "8" and format != "columnar":
+        raise click.UsageError("--bit-depth only applies to the columnar format")
     if not os.path.exists(save_dir):
         os.makedirs(save_dir)
+    if incremental:
+        pickle_new_examples(
+            dir,
+            save_dir,
+            train_val_split=split_ratio,
+            fixed_sample=fixed_sample,
+            format=format,
+            workers=workers,
+            seed=seed,
+            shard_size=shard_size,
+            depth=int(bit_depth),
+            exact_edges=exact_edges,
+            drop_duplicates=drop_duplicates,
+        )
+        return
     train_path = os.path.join(save_dir, "train.obj")
     val_path = os.path.join(save_dir, "val.obj")
-    pickle_examples(
-        glob.glob(os.path.join(dir, "*.png")),
-        train_path=train_path,
-        val_path=val_path,
-        train_val_split=split_ratio,
-        fixed_sample=fixed_sample,
-    )
+    paths = sorted(glob.glob(os.path.join(dir, "*.png")))
+    if format == "columnar":
+        columnar_examples(
+            paths,
+            train_path=train_path,
+            val_path=val_path,
+            train_val_split=split_ratio,
+            fixed_sample=fixed_sample,
+            workers=workers,
+            seed=seed,
+            depth=int(bit_depth),
+            exact_edges=exact_edges,
+            drop_duplicates=drop_duplicates,
+        )
+    else:
+        pickle_examples(
+            paths,
+            train_path=train_path,
+            val_path=val_path,
+            train_val_split=split_ratio,
+            fixed_sample=fixed_sample,
+            workers=workers,
+            seed=seed,
+            shard_size=shard_size,
+            drop_duplicates=drop_duplicates,
+        )
 
     """ pickle_examples(
         sorted(
@@ -1,7 +1,11 @@
+import sys
+
 import click
+import numpy as np
 import tensorflow as tf
 
-from neural_fonts.model.unet import UNet
+from neural_fonts.model.distributed import launch_workers, worker_info
+from neural_fonts.model.unet import UNet, UNetTF2
 
 
 @click.command()
@@ -67,6 +71,20 @@ from neural_fonts.model.unet import UNet
     default=500,
     help="number of batches in between two checkpoints",
 )
+@click.option(
+    "--checkpoint-secs",
+    type=int,
+    default=0,
+    help="also save a checkpoint when this many seconds passed since the "
+    "last one, 0 for checkpoints every --checkpoint-steps only",
+)
+@click.option(
+    "--async-checkpoint",
+    type=bool,
+    default=True,
+    help="write checkpoints in the background, training only waits for "
+    "the variables to be copied",
+)
 @click.option(
     "--flip-labels",
     type=bool,
@@ -74,6 +92,99 @@ from neural_fonts.model.unet import UNet
     help="whether flip training data labels or not, in fine tuning",
 )
 @click.option("--no-val", type=bool, default=False, help="no validation set is given")
+@click.option(
+    "--decode-cache-mb",
+    type=int,
+    default=0,
+    help="decode examples once into memory up to this many MB, "
+    "the rest is decoded every batch",
+)
+@click.option(
+    "--prefetch-depth",
+    type=int,
+    default=0,
+    help="number of batches prepared ahead of the training step, 0 to disable",
+)
+@click.option(
+    "--prefetch-workers",
+    type=int,
+    default=1,
+    help="number of threads preparing batches, with --prefetch-depth",
+)
+@click.option(
+    "--balance-labels",
+    type=float,
+    default=None,
+    help="sample labels in proportion to count ** (1 - balance): 1 trains every "
+    "font alike, 0 as often as its glyphs occur. Unset, every example once",
+)
+@click.option(
+    "--fixed-val-batches",
+    type=int,
+    default=0,
+    help="sample from this many fixed validation batches decoded once, in turn: "
+    "1 shows the same glyphs in every sample, N in every N-th. "
+    "0 for random batches",
+)
+@click.option(
+    "--tf-data",
+    type=bool,
+    default=False,
+    help="feed training batches through a tf.data pipeline instead of "
+    "feed_dict, batches are then prefetched by tf.data, not --prefetch-depth",
+)
+@click.option(
+    "--fused-step",
+    type=bool,
+    default=False,
+    help="run the one D and two G updates of a step in a single session "
+    "run instead of three",
+)
+@click.option(
+    "--summary-steps",
+    type=int,
+    default=1,
+    help="number of batches in between two summaries are written",
+)
+@click.option(
+    "--tf2",
+    type=bool,
+    default=False,
+    help="train the TF2 model with tf.function compiled steps, "
+    "it reads and writes the same checkpoints",
+)
+@click.option(
+    "--jit-compile",
+    type=bool,
+    default=False,
+    help="compile the steps of the TF2 model with XLA, with --tf2",
+)
+@click.option(
+    "--workers",
+    type=int,
+    default=1,
+    help="train the TF2 model data parallel in this many local processes, "
+    "each on its share of the batches and cores",
+)
+@click.option(
+    "--seed",
+    type=int,
+    default=None,
+    help="seed of the data shuffles and augmentation, random when unset",
+)
+@click.option(
+    "--profile-steps",
+    type=int,
+    default=0,
+    help="export step phase timings every this many steps to "
+    "logs/metrics.jsonl and logs/metrics.prom, 0 to disable",
+)
+@click.option(
+    "--trace-steps",
+    type=str,
+    default=None,
+    help="trace the steps FIRST-LAST into the log directory, for TensorBoard",
+)
 def main(
     experiment_dir: str,
     experiment_id: int,
@@ -94,46 +205,106 @@ def main(
     inst_norm: bool,
     sample_steps: int,
     checkpoint_steps: int,
+    checkpoint_secs: int,
+    async_checkpoint: bool,
     flip_labels: bool,
     no_val: bool,
+    decode_cache_mb: int,
+    prefetch_depth: int,
+    prefetch_workers: int,
+    balance_labels: float | None,
+    fixed_val_batches: int,
+    tf_data: bool,
+    fused_step: bool,
+    summary_steps: int,
+    tf2: bool,
+    jit_compile: bool,
+    workers: int,
+    seed: int | None,
+    profile_steps: int,
+    trace_steps: str | None,
 ):
     """Train"""
+    if workers > 1 and worker_info() is None:
+        if not tf2:
+            raise click.UsageError("--workers needs --tf2")
+        argv = sys.argv[:]
+        if seed is None:
+            # the workers must agree on the batches to share out
+            argv += ["--seed", str(np.random.randint(2**31))]
+        sys.exit(launch_workers(workers, argv))
+    trace_range: tuple[int, int] | None = None
+    if trace_steps is not None:
+        first, last = trace_steps.split("-")
+        trace_range = (int(first), int(last))
+    fine_tune_list: set[int] | None = None
+    if fine_tune is not None:
+        fine_tune_list = {int(i) for i in fine_tune.split(",")}
+    model_args = dict(
+        batch_size=batch_size,
+        experiment_id=experiment_id,
+        input_width=image_size,
+        output_width=image_size,
+        embedding_num=embedding_num,
+        embedding_dim=embedding_dim,
+        L1_penalty=L1_penalty,
+        Lconst_penalty=Lconst_penalty,
+        Ltv_penalty=Ltv_penalty,
+        Lcategory_penalty=Lcategory_penalty,
+    )
+    train_args = dict(
+        lr=lr,
+        epoch=epoch,
+        resume=resume,
+        schedule=schedule,
+        freeze_encoder=freeze_encoder,
+        fine_tune=fine_tune_list,
+        sample_steps=sample_steps,
+        checkpoint_steps=checkpoint_steps,
+        checkpoint_secs=checkpoint_secs,
+        async_checkpoint=async_checkpoint,
+        flip_labels=flip_labels,
+        no_val=no_val,
+        decode_budget=decode_cache_mb * 2**20,
+        prefetch_depth=prefetch_depth,
+        prefetch_workers=prefetch_workers,
+        balance_labels=balance_labels,
+        fixed_val_batches=fixed_val_batches,
+        summary_steps=summary_steps,
+        seed=seed,
+        profile_steps=profile_steps,
+        trace_steps=trace_range,
+    )
+    if tf2:
+        strategy = None
+        if worker_info() is not None:
+            strategy = tf.distribute.MultiWorkerMirroredStrategy()
+        model = UNetTF2(
+            experiment_dir,
+            inst_norm=inst_norm,
+            no_target_source=flip_labels,
+            jit_compile=jit_compile,
+            strategy=strategy,
+            **model_args,
+        )
+        model.train(**train_args)
+        return
+
     config = tf.compat.v1.ConfigProto()
     config.gpu_options.allow_growth = True
 
     with tf.compat.v1.Session(config=config) as sess:
-        model = UNet(
-            experiment_dir,
-            batch_size=batch_size,
-            experiment_id=experiment_id,
-            input_width=image_size,
-            output_width=image_size,
-            embedding_num=embedding_num,
-            embedding_dim=embedding_dim,
-            L1_penalty=L1_penalty,
-            Lconst_penalty=Lconst_penalty,
-            Ltv_penalty=Ltv_penalty,
-            Lcategory_penalty=Lcategory_penalty,
-        )
+        model = UNet(experiment_dir, **model_args)
         model.register_session(sess)
         if flip_labels:
             model.build_model(
-                is_training=True, inst_norm=inst_norm, no_target_source=True
+                is_training=True,
+                inst_norm=inst_norm,
+                no_target_source=True,
+                input_pipeline=tf_data,
             )
         else:
-            model.build_model(is_training=True, inst_norm=inst_norm)
-        fine_tune_list: set[int] | None = None
-        if fine_tune is not None:
-            fine_tune_list = {int(i) for i in fine_tune.split(",")}
-        model.train(
-            lr=lr,
-            epoch=epoch,
-            resume=resume,
-            schedule=schedule,
-            freeze_encoder=freeze_encoder,
-            fine_tune=fine_tune_list,
-            sample_steps=sample_steps,
-            checkpoint_steps=checkpoint_steps,
-            flip_labels=flip_labels,
-            no_val=no_val,
-        )
+            model.build_model(
+                is_training=True, inst_norm=inst_norm, input_pipeline=tf_data
+            )
+        model.train(fused_step=fused_step, **train_args)
@@ -0,0 +1,61 @@
+import struct
+
+from neural_fonts.cmap import glyph_coverage
+
+
+def cmap_table(mapping):
+    """
+    A cmap with a single format 4 subtable, one segment per code point
+    """
+    codes = sorted(mapping) + [0xFFFF]
+    deltas = [(mapping[c] - c) & 0xFFFF for c in codes[:-1]] + [1]
+    seg_count = len(codes)
+    subtable = struct.pack(">7H", 4, 16 + 8 * seg_count, 0, 2 * seg_count, 0, 0, 0)
+    subtable += struct.pack(">%dH" % seg_count, *codes) + b"\0\0"
+    subtable += struct.pack(">%dH" % seg_count, *codes)
+    subtable += struct.pack(">%dH" % seg_count, *deltas)
+    subtable += struct.pack(">%dH" % seg_count, *[0] * seg_count)
+    return struct.pack(">HHHHI", 0, 1, 3, 1, 12) + subtable
+
+
+def write_font(path, version, tables):
+    offset = 12 + 16 * len(tables)
+    header = struct.pack(">4sHHHH", version, len(tables), 0, 0, 0)
+    body = b""
+    for tag, table in tables.items():
+        header += struct.pack(">4sIII", tag, 0, offset + len(body), len(table))
+        body += table
+    path.write_bytes(header + body)
+    return str(path)
+
+
+# glyph 1 has an empty outline, glyph 2 a real one
+MAPPING = {ord("A"): 1, ord("B"): 2}
+
+
+def test_truetype_coverage_leaves_out_empty_glyphs(tmp_path):
+    head = bytes(50) + struct.pack(">hh", 0, 0)
+    maxp = struct.pack(">IH", 0x5000, 3)
+    # short offsets, in units of two bytes
+    loca = struct.pack(">4H", 0, 5, 5, 10)
+    path = write_font(
+        tmp_path / "font.ttf",
+        b"\0\1\0\0",
+        {
+            b"cmap": cmap_table(MAPPING),
+            b"head": head,
+            b"maxp": maxp,
+            b"loca": loca,
+            b"glyf": bytes(20),
+        },
+    )
+    assert glyph_coverage(path) == ({ord("B")}, True)
+
+
+def test_cff_coverage_can_not_check_outlines(tmp_path):
+    path = write_font(
+        tmp_path / "font.otf",
+        b"OTTO",
+        {b"CFF ": bytes(4), b"cmap": cmap_table(MAPPING)},
+    )
+    assert glyph_coverage(path) == ({ord("A"), ord("B")}, False)
@@ -0,0 +1,93 @@
+import json
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+if not hasattr(tf, "contrib"):
+    pytest.skip("the graph model needs TensorFlow 1.x", allow_module_level=True)
+
+from neural_fonts.model.unet import UNet  # noqa: E402
+from neural_fonts.package import DatasetWriter  # noqa: E402
+
+
+def make_dataset(experiment_dir, count=2, width=128, labels=2):
+    writer = DatasetWriter(str(experiment_dir / "data"), train_val_split=0.0)
+    rng = np.random.RandomState(0)
+    for i in range(count):
+        image = rng.randint(0, 256, (width, 2 * width), dtype=np.uint8)
+        writer.write(i % labels, "%04X" % (0xAC00 + i), "train", image)
+    writer.close()
+
+
+def train(experiment_dir, build=None, **kwargs):
+    """
+    Train a tiny model from fixed seeds, return its trainable variables
+    """
+    # a single thread keeps the order of float reductions fixed
+    config = tf.ConfigProto(
+        intra_op_parallelism_threads=1, inter_op_parallelism_threads=1
+    )
+    with tf.Graph().as_default():
+        tf.set_random_seed(1)
+        with tf.Session(config=config) as sess:
+            model = UNet(
+                experiment_dir=str(experiment_dir),
+                batch_size=2,
+                generator_dim=4,
+                discriminator_dim=4,
+                embedding_num=2,
+                embedding_dim=8,
+            )
+            model.register_session(sess)
+            model.build_model(is_training=True, **(build or {}))
+            model.train(no_val=True, seed=0, **kwargs)
+            return {var.op.name: sess.run(var) for var in tf.trainable_variables()}
+
+
+def test_fused_step_matches_serial(tmp_path, monkeypatch):
+    # dropout draws other masks in every run
+    monkeypatch.setattr(tf.nn, "dropout", lambda x, *args, **kwargs: x)
+    variables = []
+    for fused_step in [False, True]:
+        experiment_dir = tmp_path / ("fused" if fused_step else "serial")
+        make_dataset(experiment_dir)
+        variables.append(train(experiment_dir, epoch=1, fused_step=fused_step))
+    serial, fused = variables
+    assert serial.keys() == fused.keys()
+    for name in serial:
+        np.testing.assert_allclose(fused[name], serial[name], atol=1e-6, err_msg=name)
+
+
+@pytest.mark.parametrize(
+    "build, kwargs",
+    [
+        ({}, {}),
+        ({"input_pipeline": True}, {"fused_step": True, "async_checkpoint": False}),
+    ],
+)
+def test_train_checkpoints_and_resumes(tmp_path, build, kwargs):
+    make_dataset(tmp_path, count=4)
+    model_dir = tmp_path / "checkpoint" / "experiment_0_batch_2"
+    train(
+        tmp_path,
+        build,
+        epoch=1,
+        checkpoint_steps=1,
+        profile_steps=1,
+        trace_steps=(1, 1),
+        **kwargs,
+    )
+    state = json.loads((model_dir / "train_state.json").read_text())
+    assert (state["epoch"], state["batch"], state["step"]) == (1, 0, 2)
+    assert state["checkpoint"] == "unet.model-2"
+    metrics = (tmp_path / "logs" / "metrics.jsonl").read_text().splitlines()
+    assert [json.loads(line)["step"] for line in metrics] == [1, 2]
+
+    # a second run picks up from the checkpoint of the first
+    train(tmp_path, build, epoch=2, profile_steps=1, **kwargs)
+    state = json.loads((model_dir / "train_state.json").read_text())
+    assert (state["epoch"], state["batch"], state["step"]) == (2, 0, 4)
+    metrics = (tmp_path / "logs" / "metrics.jsonl").read_text().splitlines()
+    assert [json.loads(line)["step"] for line in metrics] == [1, 2, 3, 4]
+    assert (tmp_path / "logs" / "progress").read_text().endswith("Done")